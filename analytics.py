@@ -0,0 +1,226 @@
+# analytics.py - Tables d'agrégats pour les statistiques d'usage
+import os
+import re
+import sqlite3
+import argparse
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_PATH = os.getenv("DB_PATH", "imagegenie.db")
+BACKFILL_CHUNK = 5000
+
+
+def init_analytics_db(conn):
+    """Crée les tables d'agrégats si nécessaire"""
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_user_stats (
+            day TEXT,
+            phone TEXT,
+            images INTEGER DEFAULT 0,
+            PRIMARY KEY (day, phone)
+        )
+    ''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            images INTEGER DEFAULT 0,
+            active_users INTEGER DEFAULT 0
+        )
+    ''')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS prompt_stats (
+            prompt TEXT PRIMARY KEY,
+            uses INTEGER DEFAULT 0,
+            last_used TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_prompt_stats_uses ON prompt_stats (uses)")
+
+    # État du backfill : curseur et premier id compté en direct
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    ''')
+
+    conn.commit()
+
+
+def normalize_prompt(prompt):
+    """Clé de regroupement : minuscules, espaces compactés"""
+    return re.sub(r"\s+", " ", prompt.lower()).strip()
+
+
+def _apply(c, rows):
+    """Ajoute des générations (phone, prompt, created_at) aux agrégats"""
+    per_user = {}
+    per_prompt = {}
+    for phone, prompt, created_at in rows:
+        day = str(created_at)[:10]
+        per_user[(day, phone)] = per_user.get((day, phone), 0) + 1
+        key = normalize_prompt(prompt or "")
+        uses, last = per_prompt.get(key, (0, created_at))
+        per_prompt[key] = (uses + 1, max(str(last), str(created_at)))
+
+    per_day = {}
+    for (day, phone), images in per_user.items():
+        c.execute("INSERT OR IGNORE INTO daily_user_stats (day, phone, images) VALUES (?, ?, 0)",
+                  (day, phone))
+        new_user = c.rowcount
+        c.execute("UPDATE daily_user_stats SET images = images + ? WHERE day = ? AND phone = ?",
+                  (images, day, phone))
+        total, users = per_day.get(day, (0, 0))
+        per_day[day] = (total + images, users + new_user)
+
+    c.executemany("""
+        INSERT INTO daily_stats (day, images, active_users) VALUES (?, ?, ?)
+        ON CONFLICT(day) DO UPDATE SET images = images + excluded.images,
+                                       active_users = active_users + excluded.active_users
+    """, [(day, images, users) for day, (images, users) in per_day.items()])
+
+    c.executemany("""
+        INSERT INTO prompt_stats (prompt, uses, last_used) VALUES (?, ?, ?)
+        ON CONFLICT(prompt) DO UPDATE SET uses = uses + excluded.uses,
+                                          last_used = MAX(last_used, excluded.last_used)
+    """, [(prompt, uses, last) for prompt, (uses, last) in per_prompt.items()])
+
+
+def record_generation(c, generation_id, phone, prompt, created_at):
+    """
+    Met à jour les agrégats pour une génération.
+
+    Appelée avec le curseur de generate_image, avant son commit : la
+    génération et ses compteurs sont écrits dans la même transaction.
+    """
+    c.execute("INSERT OR IGNORE INTO analytics_state (key, value) VALUES ('first_live_id', ?)",
+              (generation_id,))
+    _apply(c, [(phone, prompt, created_at)])
+
+
+def backfill(db_path=DB_PATH, chunk_size=BACKFILL_CHUNK):
+    """
+    Agrège les générations antérieures aux mises à jour en direct.
+
+    Traite les lignes par tranches d'id (une transaction courte par tranche,
+    pour ne pas bloquer les écritures) et reprend au dernier curseur.
+    """
+    conn = sqlite3.connect(db_path)
+    init_analytics_db(conn)
+    c = conn.cursor()
+
+    # Fige la borne si aucune génération n'a encore été comptée en direct
+    c.execute("""
+        INSERT OR IGNORE INTO analytics_state (key, value)
+        SELECT 'first_live_id', COALESCE(MAX(id), 0) + 1 FROM generations
+    """)
+    conn.commit()
+    c.execute("SELECT value FROM analytics_state WHERE key = 'first_live_id'")
+    upper = c.fetchone()[0]
+
+    c.execute("SELECT value FROM analytics_state WHERE key = 'backfill_cursor'")
+    row = c.fetchone()
+    cursor = row[0] if row else 0
+
+    processed = 0
+    while cursor < upper - 1:
+        c.execute("""
+            SELECT id, phone, prompt, created_at FROM generations
+            WHERE id > ? AND id < ? ORDER BY id LIMIT ?
+        """, (cursor, upper, chunk_size))
+        rows = c.fetchall()
+        if not rows:
+            break
+
+        with conn:
+            _apply(c, [(phone, prompt, created_at) for _, phone, prompt, created_at in rows])
+            cursor = rows[-1][0]
+            c.execute("INSERT OR REPLACE INTO analytics_state (key, value) VALUES ('backfill_cursor', ?)",
+                      (cursor,))
+
+        processed += len(rows)
+        print(f"📊 Backfill: {processed} générations (id {cursor})")
+
+    conn.close()
+    return processed
+
+
+def get_stats(db_paths=(DB_PATH,), days=30, limit=10):
+    """
+    Statistiques pour /stats, lues uniquement dans les agrégats.
+
+    Avec plusieurs shards, les jours et utilisateurs s'additionnent
+    exactement (un numéro vit dans un seul shard) ; le classement des
+    prompts fusionne les meilleurs candidats de chaque shard.
+    """
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    daily = {}
+    prompts = {}
+    users = []
+
+    for db_path in db_paths:
+        conn = sqlite3.connect(db_path)
+        init_analytics_db(conn)
+        c = conn.cursor()
+
+        c.execute("SELECT day, images, active_users FROM daily_stats WHERE day >= ?", (since,))
+        for day, images, active in c.fetchall():
+            total, active_total = daily.get(day, (0, 0))
+            daily[day] = (total + images, active_total + active)
+
+        c.execute("SELECT prompt, uses FROM prompt_stats ORDER BY uses DESC LIMIT ?",
+                  (limit * len(db_paths),))
+        for prompt, uses in c.fetchall():
+            prompts[prompt] = prompts.get(prompt, 0) + uses
+
+        c.execute("""
+            SELECT phone, SUM(images) AS total FROM daily_user_stats
+            WHERE day >= ? GROUP BY phone ORDER BY total DESC LIMIT ?
+        """, (since, limit))
+        users.extend(c.fetchall())
+
+        conn.close()
+
+    daily = [{"day": day, "images": images, "active_users": active}
+             for day, (images, active) in sorted(daily.items())]
+    top_prompts = [{"prompt": prompt, "uses": uses}
+                   for prompt, uses in sorted(prompts.items(), key=lambda p: -p[1])[:limit]]
+    top_users = [{"phone": phone, "images": images}
+                 for phone, images in sorted(users, key=lambda u: -u[1])[:limit]]
+
+    return {
+        "days": days,
+        "total_images": sum(d["images"] for d in daily),
+        "daily": daily,
+        "top_prompts": top_prompts,
+        "top_users": top_users
+    }
+
+
+if __name__ == "__main__":
+    # Import tardif : storage importe ce module
+    import storage
+
+    parser = argparse.ArgumentParser(description="Backfill des agrégats d'usage")
+    parser.add_argument("--db", help="Un seul fichier SQLite (par défaut : tous les shards de DB_SHARDS)")
+    parser.add_argument("--chunk", type=int, default=BACKFILL_CHUNK)
+    args = parser.parse_args()
+
+    if storage.STORAGE_BACKEND == "postgres" and not args.db:
+        storage.get_storage().rebuild_stats()
+        print("✅ Agrégats Postgres recalculés")
+    else:
+        paths = [args.db] if args.db else storage.shard_paths(storage.DB_PATH, storage.DB_SHARDS)
+        missing = [path for path in paths if not os.path.exists(path)]
+        if missing:
+            parser.error(f"base introuvable: {', '.join(missing)}")
+        total = 0
+        for path in paths:
+            total += backfill(path, args.chunk)
+        print(f"✅ Backfill terminé: {total} générations agrégées")
@@ -1,13 +1,17 @@
 # app.py - Version avec debug amélioré
 import os
-import sqlite3
-from datetime import datetime
 from flask import Flask, request, jsonify
 import google.generativeai as genai
 from dotenv import load_dotenv
-import json
 import hashlib
+import hmac
 import requests
+import broadcast
+import storage
+import model_client
+import prompt_index
+import lifecycle
+import webhook_parser
 
 # Charger config
 load_dotenv()
@@ -20,6 +24,14 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 DEBUG_MODE = os.getenv("DEBUG_MODE", "True") == "True"
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v18.0")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+APP_SECRET = os.getenv("APP_SECRET")
+# Désactivé par défaut : chaque worker garde son propre index en mémoire (voir PROMPT_INDEX_MAX)
+PROMPT_REUSE = os.getenv("PROMPT_REUSE", "False") == "True"
+# Délai d'un envoi WhatsApp, bien en dessous de JOB_RECOVERY_GRACE : un job à l'étape
+# 'sending' n'est jamais repris pendant que son envoi est encore en cours
+WHATSAPP_SEND_TIMEOUT = float(os.getenv("WHATSAPP_SEND_TIMEOUT", "15"))
 
 # Vérification au démarrage
 print("="*50)
@@ -27,6 +39,8 @@ print("🔧 Configuration chargée:")
 print(f"GOOGLE_API_KEY: {'✅ Présente' if GOOGLE_API_KEY else '❌ MANQUANTE'}")
 print(f"WHATSAPP_TOKEN: {'✅ Présent' if WHATSAPP_TOKEN else '❌ MANQUANT'}")
 print(f"PHONE_NUMBER_ID: {PHONE_NUMBER_ID if PHONE_NUMBER_ID else '❌ MANQUANT'}")
+print(f"APP_SECRET: {'✅ Présent' if APP_SECRET else '⚠️ ABSENT (signatures non vérifiées)'}")
+print(f"JSON: {webhook_parser.JSON_BACKEND}")
 print(f"DEBUG_MODE: {DEBUG_MODE}")
 print("="*50)
 
@@ -34,37 +48,15 @@ print("="*50)
 if GOOGLE_API_KEY:
     genai.configure(api_key=GOOGLE_API_KEY)
     text_model = genai.GenerativeModel('gemini-pro')
+    gemini = model_client.ModelClient(text_model)
 else:
     print("⚠️ ATTENTION: Google API Key manquante!")
     text_model = None
+    gemini = None
 
 def init_db():
-    """Initialise la base de données SQLite"""
-    conn = sqlite3.connect('imagegenie.db')
-    c = conn.cursor()
-    
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            phone TEXT PRIMARY KEY,
-            tokens INTEGER DEFAULT 1,
-            total_generated INTEGER DEFAULT 0,
-            created_at TIMESTAMP
-        )
-    ''')
-    
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS generations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            phone TEXT,
-            prompt TEXT,
-            enhanced_prompt TEXT,
-            image_url TEXT,
-            created_at TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    """Initialise le stockage (SQLite shardé ou Postgres selon STORAGE_BACKEND)"""
+    storage.get_storage().init()
     print("✅ Base de données initialisée")
 
 def send_whatsapp_message(to_number, message):
@@ -79,7 +71,7 @@ def send_whatsapp_message(to_number, message):
         print("❌ ERREUR: Token ou Phone ID manquant!")
         return False
     
-    url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
+    url = f"{GRAPH_API_URL}/{PHONE_NUMBER_ID}/messages"
     
     headers = {
         "Authorization": f"Bearer {WHATSAPP_TOKEN}",
@@ -94,7 +86,7 @@ def send_whatsapp_message(to_number, message):
     }
     
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = requests.post(url, headers=headers, json=data, timeout=WHATSAPP_SEND_TIMEOUT)
         
         print(f"Status code: {response.status_code}")
         
@@ -135,7 +127,7 @@ def send_whatsapp_image(to_number, image_url, caption=""):
         print("❌ ERREUR: Token ou Phone ID manquant!")
         return False
     
-    url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
+    url = f"{GRAPH_API_URL}/{PHONE_NUMBER_ID}/messages"
     
     headers = {
         "Authorization": f"Bearer {WHATSAPP_TOKEN}",
@@ -153,7 +145,7 @@ def send_whatsapp_image(to_number, image_url, caption=""):
     }
     
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = requests.post(url, headers=headers, json=data, timeout=WHATSAPP_SEND_TIMEOUT)
         
         print(f"Status code: {response.status_code}")
         
@@ -169,74 +161,72 @@ def send_whatsapp_image(to_number, image_url, caption=""):
         return False
 
 def enhance_prompt(prompt):
-    """Améliore le prompt avec Gemini Pro"""
-    if not text_model:
+    """Améliore le prompt avec Gemini Pro (prompt original si lent ou indisponible)"""
+    if not gemini:
         print("⚠️ Model non disponible, utilisation du prompt original")
         return prompt
         
-    try:
-        request = f"""
-        Améliore ce prompt pour génération d'image. 
-        Ajoute des détails artistiques, éclairage, couleurs.
-        Maximum 100 mots. Réponds uniquement avec le prompt amélioré.
-        
-        Prompt: {prompt}
-        """
-        
-        response = text_model.generate_content(request)
-        return response.text.strip()
-    except Exception as e:
-        print(f"Erreur enhancement: {e}")
-        return prompt
+    request = f"""
+    Améliore ce prompt pour génération d'image. 
+    Ajoute des détails artistiques, éclairage, couleurs.
+    Maximum 100 mots. Réponds uniquement avec le prompt amélioré.
+    
+    Prompt: {prompt}
+    """
+    
+    return gemini.generate(request, fallback=prompt)
 
-def generate_image(prompt, phone):
-    """Génère une image (placeholder pour MVP)"""
+def generate_image(prompt, phone, job=None):
+    """Génère une image (placeholder pour MVP), avec points de reprise si job est fourni"""
     try:
-        # Vérifier/créer utilisateur
-        conn = sqlite3.connect('imagegenie.db')
-        c = conn.cursor()
-        
-        # Créer utilisateur si n'existe pas
-        c.execute("INSERT OR IGNORE INTO users (phone, tokens, created_at) VALUES (?, 1, ?)",
-                  (phone, datetime.now()))
-        conn.commit()
+        db = storage.get_storage()
         
-        # Vérifier les tokens
-        c.execute("SELECT tokens FROM users WHERE phone = ?", (phone,))
-        result = c.fetchone()
-        tokens = result[0]
+        # Vérifier/créer utilisateur
+        tokens, _ = db.get_or_create_user(phone)
         
         if tokens < 1:
-            conn.close()
             return {
                 "success": False,
                 "message": "❌ Crédit insuffisant! Vous avez 0 token.\n\n💡 Tapez /recharge pour acheter des tokens"
             }
         
-        # Améliorer le prompt
-        enhanced = enhance_prompt(prompt)
+        # Reprise d'un job déjà amélioré : pas de second appel à Gemini
+        resumed = bool(job and job.get('image_url'))
         
-        # Générer une URL unique (placeholder pour MVP)
-        prompt_hash = hashlib.md5(enhanced.encode()).hexdigest()[:8]
-        image_url = f"https://picsum.photos/seed/{prompt_hash}/512/512"
+        # Réutiliser une génération passée si un prompt proche existe
+        match = prompt_index.get_index().lookup(prompt) if PROMPT_REUSE and not resumed else None
         
-        print(f"🎨 Image générée: {image_url}")
-        
-        # Décrémenter tokens et sauvegarder
-        c.execute("UPDATE users SET tokens = tokens - 1, total_generated = total_generated + 1 WHERE phone = ?", (phone,))
+        if resumed:
+            enhanced, image_url = job['enhanced_prompt'], job['image_url']
+        elif match:
+            enhanced, image_url, score = match
+            print(f"♻️ Prompt similaire ({score:.2f}), image réutilisée: {image_url}")
+        else:
+            # Améliorer le prompt
+            enhanced = enhance_prompt(prompt)
+            
+            # Générer une URL unique (placeholder pour MVP)
+            prompt_hash = hashlib.md5(enhanced.encode()).hexdigest()[:8]
+            image_url = f"https://picsum.photos/seed/{prompt_hash}/512/512"
+            
+            print(f"🎨 Image générée: {image_url}")
         
-        c.execute("""
-            INSERT INTO generations (phone, prompt, enhanced_prompt, image_url, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (phone, prompt, enhanced, image_url, datetime.now()))
+        if job:
+            db.update_job(phone, job['id'], 'enhanced', ('received', 'enhanced'), enhanced, image_url)
         
-        conn.commit()
+        # Décrémenter tokens et sauvegarder (agrégats et étape du job dans la même transaction)
+        new_tokens = db.record_generation(phone, prompt, enhanced, image_url,
+                                          job_id=job['id'] if job else None)
         
-        # Récupérer le nouveau solde
-        c.execute("SELECT tokens FROM users WHERE phone = ?", (phone,))
-        new_tokens = c.fetchone()[0]
+        if new_tokens is None:
+            return {
+                "success": False,
+                "message": "❌ Crédit insuffisant! Vous avez 0 token.\n\n💡 Tapez /recharge pour acheter des tokens"
+            }
         
-        conn.close()
+        # Indexer seulement les prompts réellement améliorés (pas les replis)
+        if PROMPT_REUSE and not match and not resumed and enhanced != prompt:
+            prompt_index.get_index().add(prompt, enhanced, image_url)
         
         return {
             "success": True,
@@ -246,6 +236,9 @@ def generate_image(prompt, phone):
             "tokens_left": new_tokens
         }
         
+    except storage.JobAlreadyGenerated:
+        # Reprise concurrente : l'autre worker termine le job
+        raise
     except Exception as e:
         print(f"❌ Erreur génération: {str(e)}")
         return {
@@ -253,8 +246,17 @@ def generate_image(prompt, phone):
             "message": f"Erreur: {str(e)}"
         }
 
-def handle_whatsapp_message(from_number, text):
-    """Traite les messages WhatsApp entrants"""
+def run_image_job(job):
+    """Exécute ou reprend un job /image (enhance, generate, send)"""
+    lifecycle.process_image_job(
+        storage.get_storage(), job,
+        generate=lambda job: generate_image(job['prompt'], job['phone'], job),
+        send_image=send_whatsapp_image,
+        send_message=send_whatsapp_message
+    )
+
+def handle_whatsapp_message(from_number, text, message_id=None):
+    """Traite les messages WhatsApp entrants (message_id : wamid, clé du job /image)"""
     text = text.lower().strip()
     
     print(f"\n{'='*50}")
@@ -295,39 +297,23 @@ Tapez: /image [votre description]
             send_whatsapp_message(from_number, "❌ Description trop courte. Exemple: /image un chat sur la lune")
             return
         
+        # Job enregistré avant tout envoi : un webhook renvoyé par Meta (même wamid) est ignoré
+        job_id = storage.get_storage().create_job(from_number, prompt, message_id)
+        if job_id is None:
+            print(f"ℹ️ Message {message_id} déjà reçu, ignoré")
+            return
+        
         # Envoyer message d'attente
         send_whatsapp_message(from_number, "🎨 Génération en cours... (15 secondes)")
         
-        # Générer l'image
-        result = generate_image(prompt, from_number)
-        
-        if result['success']:
-            # Envoyer l'image
-            caption = f"✨ *Image générée avec succès!*\n\n📝 _Prompt: {result['prompt']}_\n💰 Tokens restants: {result['tokens_left']}"
-            send_whatsapp_image(from_number, result['image_url'], caption)
-            
-            # Message de suivi
-            if result['tokens_left'] == 0:
-                send_whatsapp_message(from_number, "⚠️ Vous n'avez plus de tokens!\n\nTapez /recharge pour continuer")
-        else:
-            send_whatsapp_message(from_number, result['message'])
+        # Générer et envoyer l'image (chaque étape est enregistrée pour reprise)
+        run_image_job({"id": job_id, "phone": from_number, "prompt": prompt, "step": "received",
+                       "enhanced_prompt": None, "image_url": None, "tokens_left": None})
     
     elif text in ['/solde', 'solde', '/balance', 'balance']:
         print("→ Commande SOLDE détectée")
-        # Vérifier le solde
-        conn = sqlite3.connect('imagegenie.db')
-        c = conn.cursor()
-        
-        # Créer utilisateur si n'existe pas
-        c.execute("INSERT OR IGNORE INTO users (phone, tokens, created_at) VALUES (?, 1, ?)",
-                  (from_number, datetime.now()))
-        conn.commit()
-        
-        c.execute("SELECT tokens, total_generated FROM users WHERE phone=?", (from_number,))
-        result = c.fetchone()
-        tokens = result[0] if result else 1
-        total = result[1] if result else 0
-        conn.close()
+        # Vérifier le solde (crée l'utilisateur si n'existe pas)
+        tokens, total = storage.get_storage().get_or_create_user(from_number)
         
         message = f"""💰 *Votre solde*
 
@@ -400,17 +386,32 @@ Tapez /aide pour voir les commandes"""
         
         send_whatsapp_message(from_number, default)
 
+# Démarrage du worker (aussi sous gunicorn, qui n'exécute pas __main__)
+init_db()
+
+# Arrêt propre sur SIGTERM puis reprise des jobs interrompus
+worker_lifecycle = lifecycle.Lifecycle()
+worker_lifecycle.install_signal_handler()
+lifecycle.start_recovery(worker_lifecycle, storage.get_storage(), run_image_job)
+
+# Index des prompts chargé en arrière-plan
+if PROMPT_REUSE:
+    prompt_index.start_build(storage.get_storage())
+
 @app.route('/')
 def home():
     return jsonify({
         "status": "online",
         "service": "ImageGenie WhatsApp Bot",
         "version": "1.1",
-        "ready": True,
+        "ready": worker_lifecycle.accepting,
+        "in_flight": worker_lifecycle.in_flight,
         "config": {
             "whatsapp_configured": bool(WHATSAPP_TOKEN),
             "google_ai_configured": bool(GOOGLE_API_KEY)
-        }
+        },
+        "gemini": gemini.status() if gemini else None,
+        "prompt_index": len(prompt_index.get_index()) if PROMPT_REUSE else None
     })
 
 @app.route('/webhook', methods=['GET', 'POST'])
@@ -429,29 +430,27 @@ def webhook():
         return 'Invalid', 403
     
     if request.method == 'POST':
-        # Réception des messages
-        data = request.json
+        # Réception des messages (corps brut, décodé seulement si nécessaire)
+        raw_body = request.get_data(cache=False)
+        
+        if APP_SECRET and not webhook_parser.verify_signature(
+                raw_body, request.headers.get('X-Hub-Signature-256'), APP_SECRET):
+            print("❌ Signature webhook invalide")
+            return 'Invalid signature', 403
         
         try:
-            # Extraire le message
-            entry = data.get('entry', [{}])[0]
-            changes = entry.get('changes', [{}])[0]
-            value = changes.get('value', {})
-            
-            if 'messages' in value:
-                message = value['messages'][0]
-                from_number = message['from']
-                msg_type = message['type']
-                
-                if msg_type == 'text':
-                    text = message['text']['body']
-                    
+            # Pendant l'arrêt, 503 : Meta renverra le webhook à un autre worker
+            with worker_lifecycle.work():
+                # Les livraisons de statuts sont ignorées sans décoder le JSON
+                for message_id, from_number, text in webhook_parser.extract_text_messages(raw_body):
                     # Traiter le message
-                    handle_whatsapp_message(from_number, text)
+                    handle_whatsapp_message(from_number, text, message_id)
             
+        except lifecycle.Draining:
+            return 'Draining', 503
         except Exception as e:
             print(f"❌ Erreur webhook: {e}")
-            print(f"Data reçue: {json.dumps(data, indent=2)}")
+            print(f"Data reçue: {webhook_parser.preview(raw_body)}")
         
         return 'OK', 200
 
@@ -470,12 +469,72 @@ def test_message():
         "message": message
     })
 
+def is_admin_request():
+    """Vérifie le jeton admin (en-tête X-Admin-Token)"""
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+
+@app.route('/stats')
+def stats():
+    """Statistiques d'usage (lues dans les tables d'agrégats)"""
+    if not is_admin_request():
+        return jsonify({"error": "unauthorized"}), 403
+    
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    
+    return jsonify(storage.get_storage().get_stats(days=days, limit=limit))
+
+@app.route('/admin/broadcast', methods=['POST'])
+def admin_broadcast():
+    """Lance ou reprend une campagne vers tous les utilisateurs"""
+    if not is_admin_request():
+        return jsonify({"error": "unauthorized"}), 403
+    
+    data = request.get_json(silent=True) or {}
+    
+    if data.get('resume'):
+        try:
+            broadcast_id = int(data['resume'])
+        except (TypeError, ValueError):
+            return jsonify({"error": "resume doit être un id de campagne"}), 400
+    elif data.get('message') or data.get('template'):
+        # Hors fenêtre de 24 h, seul un modèle approuvé (template) est délivré
+        broadcast_id = broadcast.create_broadcast(data.get('message'), data.get('template'),
+                                                  data.get('language') or broadcast.BROADCAST_TEMPLATE_LANGUAGE)
+    else:
+        return jsonify({"error": "message, template ou resume requis"}), 400
+    
+    try:
+        broadcast.start_broadcast_thread(broadcast_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    except broadcast.BroadcastConflict as e:
+        return jsonify({"error": str(e)}), 409
+    
+    return jsonify({"id": broadcast_id, "status": "started"}), 202
+
+@app.route('/admin/broadcast/<int:broadcast_id>', methods=['GET', 'DELETE'])
+def admin_broadcast_status(broadcast_id):
+    """Statistiques en direct (GET) ou pause (DELETE) d'une campagne"""
+    if not is_admin_request():
+        return jsonify({"error": "unauthorized"}), 403
+    
+    if request.method == 'DELETE':
+        stopped = broadcast.stop_broadcast(broadcast_id)
+        return jsonify({"id": broadcast_id, "stopping": stopped})
+    
+    stats = broadcast.get_broadcast_stats(broadcast_id)
+    if not stats:
+        return jsonify({"error": "not found"}), 404
+    
+    return jsonify(stats)
+
 if __name__ == '__main__':
     print("="*50)
     print("🚀 ImageGenie WhatsApp Bot v1.1")
     print("="*50)
     
-    init_db()
-    
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=DEBUG_MODE)
\ No newline at end of file
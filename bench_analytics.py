@@ -0,0 +1,111 @@
+# bench_analytics.py - Compare agrégats et requêtes brutes sur generations
+import os
+import time
+import random
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+import analytics
+
+NB_GENERATIONS = int(os.getenv("NB_GENERATIONS", "2000000"))
+NB_USERS = 50000
+NB_DAYS = 180
+
+PROMPTS = [f"{sujet} {style}" for sujet in
+           ["un logo pour restaurant africain", "un chat sur la lune", "coucher de soleil sur la plage",
+            "logo moderne pour boutique", "portrait de femme en pagne", "affiche de concert",
+            "paysage de savane", "marché de cotonou", "voiture de sport rouge", "robot futuriste"]
+           for style in ["", "moderne", "réaliste", "style cartoon", "aquarelle", "minimaliste",
+                         "néon", "vintage", "3d", "noir et blanc"]]
+
+
+def create_generations(db_path, count):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS generations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone TEXT,
+            prompt TEXT,
+            enhanced_prompt TEXT,
+            image_url TEXT,
+            created_at TIMESTAMP
+        )
+    ''')
+
+    start = datetime.now() - timedelta(days=NB_DAYS)
+    step = timedelta(days=NB_DAYS) / count
+    rng = random.Random(42)
+
+    def rows():
+        for i in range(count):
+            yield (f"229{rng.randrange(NB_USERS):08d}",
+                   PROMPTS[min(int(rng.paretovariate(1.2)) - 1, len(PROMPTS) - 1)],
+                   "", "", str(start + step * i))
+
+    conn.executemany("INSERT INTO generations (phone, prompt, enhanced_prompt, image_url, created_at) "
+                     "VALUES (?, ?, ?, ?, ?)", rows())
+    conn.commit()
+    conn.close()
+
+
+def timed(label, fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"  {label:<40} {best * 1000:10.2f} ms")
+    return best
+
+
+def raw_stats(db_path, days=30, limit=10):
+    """Mêmes statistiques que get_stats, calculées sur la table brute"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    c.execute("""
+        SELECT substr(created_at, 1, 10) AS day, COUNT(*), COUNT(DISTINCT phone)
+        FROM generations WHERE created_at >= ? GROUP BY day ORDER BY day
+    """, (since,))
+    c.fetchall()
+    c.execute("SELECT lower(trim(prompt)) AS p, COUNT(*) AS n FROM generations "
+              "GROUP BY p ORDER BY n DESC LIMIT ?", (limit,))
+    c.fetchall()
+    c.execute("SELECT phone, COUNT(*) AS n FROM generations WHERE created_at >= ? "
+              "GROUP BY phone ORDER BY n DESC LIMIT ?", (since, limit))
+    c.fetchall()
+    conn.close()
+
+
+if __name__ == "__main__":
+    print("="*50)
+    print(f"BENCHMARK AGRÉGATS ({NB_GENERATIONS} générations)")
+    print("="*50)
+
+    db_path = os.path.join(tempfile.mkdtemp(), "bench_analytics.db")
+
+    start = time.perf_counter()
+    create_generations(db_path, NB_GENERATIONS)
+    print(f"🗄️ Données créées en {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    analytics.backfill(db_path)
+    print(f"📊 Backfill en {time.perf_counter() - start:.1f}s")
+
+    print("\n⏱️ /stats (meilleur de 5):")
+    raw = timed("requêtes brutes sur generations", lambda: raw_stats(db_path))
+    rollup = timed("tables d'agrégats", lambda: analytics.get_stats([db_path]))
+    print(f"\n🚀 Accélération: x{raw / rollup:.0f}")
+
+    # Coût ajouté à chaque génération par la mise à jour incrémentale
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    n = 2000
+    start = time.perf_counter()
+    for i in range(n):
+        analytics.record_generation(c, NB_GENERATIONS + i + 1, f"229{i % NB_USERS:08d}",
+                                    PROMPTS[i % len(PROMPTS)], datetime.now())
+        conn.commit()
+    print(f"✍️ Mise à jour incrémentale: {(time.perf_counter() - start) / n * 1e6:.0f} µs/génération (commit inclus)")
+    conn.close()
@@ -0,0 +1,87 @@
+# bench_prompt_index.py - Latence de recherche et mémoire de l'index de prompts
+import os
+import time
+import random
+import resource
+
+import prompt_index
+
+NB_PROMPTS = int(os.getenv("NB_PROMPTS", "1000000"))
+NB_LOOKUPS = 2000
+
+SUJETS = ["logo", "affiche", "portrait", "paysage", "chat", "chien", "voiture", "maison", "robot",
+          "marché", "plage", "femme", "homme", "enfant", "restaurant", "boutique", "église", "forêt",
+          "lion", "éléphant", "ville", "village", "fleur", "gâteau", "mariage", "concert", "football"]
+ADJECTIFS = ["africain", "moderne", "réaliste", "cartoon", "coloré", "minimaliste", "néon", "vintage",
+             "futuriste", "élégant", "lumineux", "sombre", "traditionnel", "béninois", "doré", "bleu",
+             "rouge", "vert", "géant", "petit", "magique", "festif", "calme", "sauvage"]
+LIEUX = ["sur la lune", "à cotonou", "au coucher du soleil", "sous la pluie", "dans la savane",
+         "en ville", "au bord de la mer", "la nuit", "en hiver", "au marché", "dans l'espace"]
+
+
+def random_prompt(rng):
+    words = [rng.choice(SUJETS), rng.choice(SUJETS)] + rng.sample(ADJECTIFS, rng.randint(1, 3))
+    return f"un {' '.join(words)} {rng.choice(LIEUX)} n{rng.randrange(1000)}"
+
+
+def variant(rng, prompt):
+    """Variante proche : majuscules, accents retirés, ponctuation, un adjectif en plus"""
+    words = prompt.split()
+    words.insert(rng.randint(1, len(words) - 1), rng.choice(ADJECTIFS))
+    return ("la " + " ".join(words) + " !").replace("é", "e").upper()
+
+
+def opposite(rng, prompt):
+    """Sens différent : préposition changée ou sujets inversés"""
+    words = prompt.split()
+    if rng.random() < 0.5 and words[1] != words[2]:
+        words[1], words[2] = words[2], words[1]
+    else:
+        words.insert(-1, rng.choice(["sans", "avec", "sous"]))
+    return " ".join(words)
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == "__main__":
+    print("="*50)
+    print(f"BENCHMARK INDEX DE PROMPTS ({NB_PROMPTS} prompts, numpy: {prompt_index.np is not None})")
+    print("="*50)
+
+    rng = random.Random(1)
+    prompts = [random_prompt(rng) for _ in range(NB_PROMPTS)]
+
+    before = rss_mb()
+    # Sans plafond : mesure à pleine taille
+    index = prompt_index.PromptIndex(max_entries=NB_PROMPTS)
+    start = time.perf_counter()
+    for i in range(0, NB_PROMPTS, prompt_index.BUILD_BATCH):
+        index.add_many((p, f"enhanced {p}", f"https://picsum.photos/seed/{j}/512/512")
+                       for j, p in enumerate(prompts[i:i + prompt_index.BUILD_BATCH], i))
+    build = time.perf_counter() - start
+    used = rss_mb() - before
+
+    print(f"🏗️ Construction: {build:.1f}s ({NB_PROMPTS / build:.0f} prompts/s), {len(index)} distincts")
+    print(f"💾 Mémoire (RSS max): +{used:.0f} Mo, dont signatures {index.memory_bytes() / 1e6:.0f} Mo")
+
+    for label, queries in [
+        ("variantes de prompts indexés", [variant(rng, rng.choice(prompts)) for _ in range(NB_LOOKUPS)]),
+        ("prompts inconnus", [random_prompt(rng).replace(" n", " x") for _ in range(NB_LOOKUPS)]),
+        ("sens différent (0% attendu)", [opposite(rng, rng.choice(prompts)) for _ in range(NB_LOOKUPS)]),
+    ]:
+        timings, hits = [], 0
+        for query in queries:
+            start = time.perf_counter()
+            hits += index.lookup(query) is not None
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f"🔎 {label}: p50 {timings[len(timings) // 2] * 1e6:.0f} µs, "
+              f"p99 {timings[int(len(timings) * 0.99)] * 1e6:.0f} µs, {hits / len(queries):.0%} trouvés")
+
+    # Ajout incrémental (une génération à la fois)
+    start = time.perf_counter()
+    for i in range(NB_LOOKUPS):
+        index.add(random_prompt(rng) + " nouveau", "enhanced", "url")
+    print(f"➕ Ajout incrémental: {(time.perf_counter() - start) / NB_LOOKUPS * 1e6:.0f} µs/prompt")
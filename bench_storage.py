@@ -0,0 +1,56 @@
+# bench_storage.py - Débit d'écriture selon le nombre de shards SQLite
+import os
+import time
+import random
+import tempfile
+import multiprocessing
+
+import storage
+
+# Un processus par worker gunicorn : chacun a ses propres pools de connexions
+NB_WORKERS = int(os.getenv("NB_WORKERS", "8"))
+NB_WRITES = int(os.getenv("NB_WRITES", "20000"))
+NB_USERS = 10000
+SHARD_COUNTS = [1, 2, 4, 8]
+
+
+def worker(paths, seed, count):
+    store = storage.SqliteShardedStorage(paths, pool_size=1)
+    rng = random.Random(seed)
+    for _ in range(count):
+        phone = f"229{rng.randrange(NB_USERS):08d}"
+        store.record_generation(phone, "un logo pour restaurant africain",
+                                "enhanced", "https://picsum.photos/seed/abc/512/512")
+
+
+def bench(shards):
+    tmp = tempfile.mkdtemp()
+    paths = storage.shard_paths(os.path.join(tmp, "bench.db"), shards)
+    store = storage.SqliteShardedStorage(paths)
+    store.init()
+    store.import_users([(f"229{i:08d}", 1000000, 0, "2024-01-01 00:00:00") for i in range(NB_USERS)])
+
+    per_worker = NB_WRITES // NB_WORKERS
+    workers = [multiprocessing.Process(target=worker, args=(paths, i, per_worker))
+               for i in range(NB_WORKERS)]
+    start = time.perf_counter()
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    elapsed = time.perf_counter() - start
+
+    assert store.count_generations() == per_worker * NB_WORKERS
+    return per_worker * NB_WORKERS / elapsed
+
+
+if __name__ == "__main__":
+    print("="*50)
+    print(f"BENCHMARK ÉCRITURES ({NB_WRITES} générations, {NB_WORKERS} processus, {os.cpu_count()} CPU)")
+    print("="*50)
+
+    baseline = None
+    for shards in SHARD_COUNTS:
+        rate = bench(shards)
+        baseline = baseline or rate
+        print(f"  {shards} shard(s): {rate:8.0f} générations/s  (x{rate / baseline:.2f})")
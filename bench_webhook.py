@@ -0,0 +1,111 @@
+# bench_webhook.py - Coût d'ingestion d'un webhook par requête
+import hmac
+import json
+import time
+import hashlib
+
+import webhook_parser
+
+APP_SECRET = "bench-secret"
+
+
+def text_payload(nb_messages=1, body="/image un logo pour restaurant africain"):
+    """Webhook au format Meta avec nb_messages messages texte"""
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{
+            "id": "102290129340398",
+            "changes": [{
+                "field": "messages",
+                "value": {
+                    "messaging_product": "whatsapp",
+                    "metadata": {"display_phone_number": "15550783881", "phone_number_id": "106540352242922"},
+                    "contacts": [{"profile": {"name": f"Client {i}"}, "wa_id": f"229970000{i:02d}"}
+                                 for i in range(nb_messages)],
+                    "messages": [{
+                        "from": f"229970000{i:02d}",
+                        "id": f"wamid.HBgLMTY1MDM4Nzk0MzkVAgASGBQzQTRBNjU5OUFFRTAzODEwMTQ0RgA{i}",
+                        "timestamp": "1712345678",
+                        "type": "text",
+                        "text": {"body": body}
+                    } for i in range(nb_messages)]
+                }
+            }]
+        }]
+    }
+
+
+def status_payload(nb_statuses=1):
+    """Webhook de statuts (sent/delivered/read) que le bot ignore"""
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{
+            "id": "102290129340398",
+            "changes": [{
+                "field": "messages",
+                "value": {
+                    "messaging_product": "whatsapp",
+                    "metadata": {"display_phone_number": "15550783881", "phone_number_id": "106540352242922"},
+                    "statuses": [{
+                        "id": f"wamid.HBgLMTY1MDM4Nzk0MzkVAgARGBI4QUM1{i}",
+                        "status": "delivered",
+                        "timestamp": "1712345679",
+                        "recipient_id": f"229970000{i:02d}",
+                        "conversation": {"id": "b1d2e3f4a5", "origin": {"type": "service"}},
+                        "pricing": {"billable": True, "pricing_model": "CBP", "category": "service"}
+                    } for i in range(nb_statuses)]
+                }
+            }]
+        }]
+    }
+
+
+def legacy_ingest(raw_body):
+    """Ancien chemin : décodage complet puis premier message seulement"""
+    data = json.loads(raw_body)
+    entry = data.get('entry', [{}])[0]
+    changes = entry.get('changes', [{}])[0]
+    value = changes.get('value', {})
+    if 'messages' in value:
+        message = value['messages'][0]
+        if message['type'] == 'text':
+            return [(message['from'], message['text']['body'])]
+    return []
+
+
+def new_ingest(raw_body, signature):
+    """Nouveau chemin : signature sur le corps brut puis extraction ciblée"""
+    if not webhook_parser.verify_signature(raw_body, signature, APP_SECRET):
+        raise ValueError("signature")
+    return webhook_parser.extract_text_messages(raw_body)
+
+
+def bench(fn, *args, n=20000):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn(*args)
+    return (time.perf_counter() - start) / n * 1e6
+
+
+if __name__ == "__main__":
+    print("="*50)
+    print(f"BENCHMARK WEBHOOK (JSON: {webhook_parser.JSON_BACKEND})")
+    print("="*50)
+
+    cases = [
+        ("statut seul", status_payload(1)),
+        ("statuts x20", status_payload(20)),
+        ("1 message texte", text_payload(1)),
+        ("20 messages texte", text_payload(20)),
+        ("1 message long (4 Ko)", text_payload(1, "x" * 4096)),
+    ]
+
+    print(f"\n{'payload':<24}{'taille':>9}{'ancien':>12}{'nouveau':>12}{'dont HMAC':>12}")
+    for label, payload in cases:
+        raw = json.dumps(payload).encode()
+        signature = "sha256=" + hmac.new(APP_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+
+        legacy = bench(legacy_ingest, raw)
+        new = bench(new_ingest, raw, signature)
+        signing = bench(webhook_parser.verify_signature, raw, signature, APP_SECRET)
+        print(f"{label:<24}{len(raw):>7} o{legacy:>9.1f} µs{new:>9.1f} µs{signing:>9.1f} µs")
@@ -0,0 +1,350 @@
+# broadcast.py - Envoi de campagnes WhatsApp à tous les utilisateurs
+import os
+import sys
+import time
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+import storage
+
+load_dotenv()
+
+# Configuration
+GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v18.0")
+WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
+PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
+
+# Limites Graph API : 80 messages/s par numéro sur le palier standard
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "80"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+MAX_RETRIES = 3
+# Palier de messagerie Meta : destinataires distincts par 24 h glissantes (0 = sans limite)
+BROADCAST_DAILY_LIMIT = int(os.getenv("BROADCAST_DAILY_LIMIT", "1000"))
+BROADCAST_TEMPLATE_LANGUAGE = os.getenv("BROADCAST_TEMPLATE_LANGUAGE", "fr")
+# Une campagne 'running' sans checkpoint depuis ce délai est considérée comme abandonnée (crash)
+BROADCAST_STALE_AFTER = float(os.getenv("BROADCAST_STALE_AFTER", "300"))
+
+# Campagnes en cours dans ce processus (id -> BroadcastStats)
+_running = {}
+_running_lock = threading.Lock()
+
+
+class BroadcastConflict(Exception):
+    """La campagne tourne déjà (ici ou dans un autre processus) ou est terminée"""
+
+
+class RateLimiter:
+    """Seau à jetons partagé entre les workers"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class GraphSender:
+    """
+    Envoi de messages via la Graph API (connexions réutilisées).
+
+    Le texte libre n'est accepté que dans les 24 h qui suivent le dernier
+    message de l'utilisateur (sinon erreur 131047) ; hors de cette fenêtre
+    il faut un modèle approuvé par Meta.
+    """
+
+    def __init__(self, pool_size=BROADCAST_CONCURRENCY, base_url=None, token=None, phone_number_id=None):
+        self.url = f"{base_url or GRAPH_API_URL}/{phone_number_id or PHONE_NUMBER_ID}/messages"
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {token or WHATSAPP_TOKEN}",
+            "Content-Type": "application/json"
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __call__(self, to_number, message, template=None):
+        """Retourne (succès, status_code, erreur) ; template = (nom, code langue)"""
+        data = {
+            "messaging_product": "whatsapp",
+            "to": to_number
+        }
+        if template:
+            name, language = template
+            data["type"] = "template"
+            data["template"] = {"name": name, "language": {"code": language}}
+            if message:
+                # Message passé en variable {{1}} du corps du modèle
+                data["template"]["components"] = [
+                    {"type": "body", "parameters": [{"type": "text", "text": message}]}
+                ]
+        else:
+            data["type"] = "text"
+            data["text"] = {"body": message[:4096]}  # Limite WhatsApp
+
+        try:
+            response = self.session.post(self.url, json=data, timeout=15)
+        except Exception as e:
+            return False, 0, str(e)
+
+        if response.status_code == 200:
+            return True, 200, None
+        return False, response.status_code, response.text[:500]
+
+
+class BroadcastStats:
+    """Compteurs en direct d'une campagne"""
+
+    def __init__(self, broadcast_id, total, sent=0, failed=0):
+        self.broadcast_id = broadcast_id
+        self.total = total
+        self.sent = sent
+        self.failed = failed
+        self.status = "running"
+        self.started_at = time.monotonic()
+        self.done_at_start = sent + failed
+        self.stop_event = threading.Event()
+
+    def to_dict(self):
+        done = self.sent + self.failed
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        rate = (done - self.done_at_start) / elapsed
+        remaining = max(self.total - done, 0)
+        return {
+            "id": self.broadcast_id,
+            "status": self.status,
+            "total": self.total,
+            "sent": self.sent,
+            "failed": self.failed,
+            "elapsed_s": round(elapsed, 1),
+            "rate_per_s": round(rate, 1),
+            "eta_s": round(remaining / rate, 1) if rate > 0 else None
+        }
+
+
+def _deliver(sender, limiter, phone, message, template):
+    """Envoie un message avec retry sur limitation (429) et erreurs serveur"""
+    for attempt in range(MAX_RETRIES):
+        limiter.acquire()
+        success, status_code, error = sender(phone, message, template)
+        if success or (status_code != 429 and status_code < 500 and status_code != 0):
+            break
+        time.sleep(0.5 * 2 ** attempt)
+    return phone, success, status_code, error
+
+
+def create_broadcast(message, template=None, language=BROADCAST_TEMPLATE_LANGUAGE, store=None):
+    """Enregistre une nouvelle campagne (texte libre, ou modèle Meta si template) et retourne son id"""
+    return (store or storage.get_storage()).create_broadcast(message, template, language if template else None)
+
+
+def _checkpoint(store, broadcast_id, page, results, stats):
+    """Écrit les résultats d'une page et avance le point de reprise (une transaction)"""
+    sent = sum(1 for r in results if r[1])
+    # Pause demandée depuis une autre instance (route DELETE)
+    if store.checkpoint_broadcast(broadcast_id, page[-1], results):
+        stats.stop_event.set()
+
+    stats.sent += sent
+    stats.failed += len(results) - sent
+
+
+def claim_broadcast(broadcast_id, store=None, stale_after=BROADCAST_STALE_AFTER):
+    """
+    Réserve une campagne pour ce processus avant de l'envoyer.
+
+    Refusée si elle tourne déjà ici (_running) ou ailleurs : le passage à
+    'running' est un UPDATE conditionnel dans le stockage partagé, un seul
+    lanceur peut gagner, quelle que soit l'instance. Une campagne 'running'
+    sans checkpoint récent (processus tué) peut être reprise. Retourne
+    (campagne, stats), la campagne étant le dict lu dans le stockage.
+    """
+    store = store or storage.get_storage()
+    row = store.get_broadcast(broadcast_id)
+    if not row:
+        raise ValueError(f"Campagne {broadcast_id} introuvable")
+    if row["status"] == "done":
+        raise BroadcastConflict(f"Campagne {broadcast_id} déjà terminée")
+
+    total = store.count_users()
+
+    with _running_lock:
+        if broadcast_id in _running:
+            raise BroadcastConflict(f"Campagne {broadcast_id} déjà en cours")
+        if not store.claim_broadcast(broadcast_id, datetime.now() - timedelta(seconds=stale_after)):
+            raise BroadcastConflict(f"Campagne {broadcast_id} déjà en cours dans un autre processus")
+        stats = BroadcastStats(broadcast_id, total, row["sent"], row["failed"])
+        _running[broadcast_id] = stats
+
+    return row, stats
+
+
+def run_broadcast(broadcast_id, sender=None, concurrency=BROADCAST_CONCURRENCY, rate=BROADCAST_RATE,
+                  page_size=BROADCAST_PAGE_SIZE, daily_limit=BROADCAST_DAILY_LIMIT, store=None, claimed=None):
+    """
+    Envoie (ou reprend) une campagne.
+
+    Les destinataires sont lus page par page dans le stockage des
+    utilisateurs (store), qui garde aussi l'état de la campagne.
+    Chaque page terminée est enregistrée avec le point de reprise, donc un
+    crash ne renvoie au pire que les pages en cours. La campagne se met
+    en pause quand daily_limit destinataires distincts ont été joints en
+    24 h (toutes campagnes confondues). claimed est le résultat de
+    claim_broadcast quand l'appelant a déjà réservé la campagne.
+    """
+    store = store or storage.get_storage()
+    campaign, stats = claimed or claim_broadcast(broadcast_id, store)
+    message, last_phone, total = campaign["message"], campaign["last_phone"], stats.total
+    template = (campaign["template"], campaign["language"]) if campaign["template"] else None
+    budget = None
+    if daily_limit:
+        budget = daily_limit - store.count_broadcast_recipients(datetime.now() - timedelta(days=1))
+
+    sender = sender or GraphSender(pool_size=concurrency)
+    limiter = RateLimiter(rate)
+
+    print(f"📣 Campagne {broadcast_id}: reprise après '{last_phone}'" if last_phone
+          else f"📣 Campagne {broadcast_id}: {total} destinataires")
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            # Une page d'avance pour que le pool ne se vide pas pendant le checkpoint
+            pending = deque()
+            for page in store.iter_phones(last_phone, page_size):
+                if stats.stop_event.is_set():
+                    break
+                if budget is not None:
+                    if budget <= 0:
+                        print(f"⏸️ Campagne {broadcast_id}: limite de {daily_limit} destinataires "
+                              "par 24 h atteinte")
+                        stats.stop_event.set()
+                        break
+                    # Le point de reprise suit la page tronquée
+                    page = page[:budget]
+                    budget -= len(page)
+                futures = [pool.submit(_deliver, sender, limiter, phone, message, template) for phone in page]
+                pending.append((page, futures))
+                if len(pending) > 1:
+                    done_page, done_futures = pending.popleft()
+                    _checkpoint(store, broadcast_id, done_page, [f.result() for f in done_futures], stats)
+
+            while pending:
+                done_page, done_futures = pending.popleft()
+                _checkpoint(store, broadcast_id, done_page, [f.result() for f in done_futures], stats)
+
+        stats.status = "paused" if stats.stop_event.is_set() else "done"
+    except Exception as e:
+        print(f"❌ Erreur campagne {broadcast_id}: {e}")
+        stats.status = "paused"
+        raise
+    finally:
+        store.finish_broadcast(broadcast_id, stats.status)
+        with _running_lock:
+            _running.pop(broadcast_id, None)
+
+    print(f"✅ Campagne {broadcast_id} {stats.status}: {stats.sent} envoyés, {stats.failed} échecs")
+    return stats
+
+
+def start_broadcast_thread(broadcast_id, **kwargs):
+    """
+    Lance une campagne en arrière-plan (route admin).
+
+    La réservation est faite avant de démarrer le thread : ValueError
+    (id inconnu) et BroadcastConflict remontent à l'appelant.
+    """
+    claimed = claim_broadcast(broadcast_id, kwargs.get("store"))
+    thread = threading.Thread(target=run_broadcast, args=(broadcast_id,), kwargs={**kwargs, "claimed": claimed},
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def stop_broadcast(broadcast_id, store=None):
+    """Demande l'arrêt d'une campagne en cours, ici ou ailleurs ; elle reste reprenable"""
+    with _running_lock:
+        stats = _running.get(broadcast_id)
+    if stats:
+        stats.stop_event.set()
+        return True
+    # Lancée par une autre instance : elle verra la demande à son prochain checkpoint
+    return (store or storage.get_storage()).request_broadcast_stop(broadcast_id)
+
+
+def get_broadcast_stats(broadcast_id, store=None):
+    """Statistiques en direct si la campagne tourne ici, sinon depuis le stockage partagé"""
+    with _running_lock:
+        stats = _running.get(broadcast_id)
+    if stats:
+        return stats.to_dict()
+
+    row = (store or storage.get_storage()).get_broadcast(broadcast_id)
+    if not row:
+        return None
+
+    return {
+        "id": broadcast_id,
+        "status": row["status"],
+        "sent": row["sent"],
+        "failed": row["failed"],
+        "created_at": row["created_at"],
+        "finished_at": row["finished_at"]
+    }
+
+
+# Lancement en ligne de commande
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Campagne WhatsApp vers tous les utilisateurs")
+    parser.add_argument("message", nargs="?", help="Texte à envoyer (variable {{1}} avec --template)")
+    parser.add_argument("--template", help="Modèle Meta approuvé, requis hors fenêtre de 24 h")
+    parser.add_argument("--language", default=BROADCAST_TEMPLATE_LANGUAGE, help="Code langue du modèle")
+    parser.add_argument("--resume", type=int, help="Reprendre la campagne avec cet id")
+    parser.add_argument("--rate", type=float, default=BROADCAST_RATE, help="Messages par seconde")
+    parser.add_argument("--concurrency", type=int, default=BROADCAST_CONCURRENCY)
+    args = parser.parse_args()
+
+    if not (args.message or args.template) and not args.resume:
+        parser.error("message, --template ou --resume requis")
+
+    # Crée les tables de campagnes si nécessaire
+    storage.get_storage().init()
+    broadcast_id = args.resume or create_broadcast(args.message, args.template, args.language)
+    try:
+        thread = start_broadcast_thread(broadcast_id, rate=args.rate, concurrency=args.concurrency)
+    except (ValueError, BroadcastConflict) as e:
+        sys.exit(f"❌ {e}")
+
+    # Affichage du débit en direct
+    try:
+        while thread.is_alive():
+            thread.join(2)
+            stats = get_broadcast_stats(broadcast_id)
+            if stats and stats["status"] == "running":
+                sys.stdout.write(f"\r📊 {stats['sent']} envoyés, {stats['failed']} échecs, "
+                                 f"{stats['rate_per_s']} msg/s, ETA {stats['eta_s']}s   ")
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        print(f"\n⏸️ Arrêt demandé, reprise possible avec --resume {broadcast_id}")
+        stop_broadcast(broadcast_id)
+        thread.join()
+    print()
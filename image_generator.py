@@ -5,6 +5,7 @@ import json
 import base64
 from dotenv import load_dotenv
 import google.generativeai as genai
+from model_client import ModelClient
 
 load_dotenv()
 
@@ -13,23 +14,21 @@ class ImageGenerator:
         self.api_key = os.getenv('GOOGLE_API_KEY')
         genai.configure(api_key=self.api_key)
         self.text_model = genai.GenerativeModel('gemini-pro')
+        self.client = ModelClient(self.text_model)
         
     def enhance_prompt(self, prompt):
         """Améliore le prompt avec Gemini Pro"""
-        try:
-            enhancement_request = f"""
-            Transform this request into a detailed image generation prompt.
-            Add artistic style, lighting, colors, and composition details.
-            Keep it under 100 words.
-            Request: {prompt}
-            
-            Reply only with the enhanced prompt.
-            """
-            
-            response = self.text_model.generate_content(enhancement_request)
-            return response.text.strip()
-        except:
-            return prompt  # Retourne l'original si erreur
+        enhancement_request = f"""
+        Transform this request into a detailed image generation prompt.
+        Add artistic style, lighting, colors, and composition details.
+        Keep it under 100 words.
+        Request: {prompt}
+        
+        Reply only with the enhanced prompt.
+        """
+        
+        # Retourne l'original si erreur, délai dépassé ou disjoncteur ouvert
+        return self.client.generate(enhancement_request, fallback=prompt)
     
     def generate_image_url(self, prompt):
         """
@@ -0,0 +1,162 @@
+# lifecycle.py - Arrêt propre des workers et reprise des jobs /image interrompus
+import os
+import signal
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+import storage
+
+load_dotenv()
+
+# Configuration
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "25"))
+# Un job sans progression depuis ce délai est considéré comme abandonné
+JOB_RECOVERY_GRACE = float(os.getenv("JOB_RECOVERY_GRACE", "120"))
+JOB_RECOVERY_INTERVAL = float(os.getenv("JOB_RECOVERY_INTERVAL", "60"))
+
+
+class Draining(Exception):
+    """Le worker s'arrête et n'accepte plus de travail"""
+
+
+class Lifecycle:
+    """Compte le travail en cours et le laisse finir à la réception de SIGTERM"""
+
+    def __init__(self, drain_timeout=DRAIN_TIMEOUT):
+        self.drain_timeout = drain_timeout
+        self.accepting = True
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def work(self):
+        """Encadre un traitement ; lève Draining si l'arrêt a commencé"""
+        with self.cond:
+            if not self.accepting:
+                raise Draining()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.in_flight -= 1
+                self.cond.notify_all()
+
+    def drain(self, timeout=None):
+        """Refuse le nouveau travail et attend la fin du travail en cours"""
+        with self.cond:
+            self.accepting = False
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: self.in_flight == 0,
+                                      self.drain_timeout if timeout is None else timeout)
+
+    def install_signal_handler(self):
+        """
+        Remplace le gestionnaire SIGTERM (celui de gunicorn ou le défaut).
+
+        Le drain se fait dans un thread : le thread principal doit pouvoir
+        terminer la requête en cours. Le gestionnaire précédent est ensuite
+        appelé pour que le worker s'arrête normalement. Aucun print dans le
+        gestionnaire lui-même : interrompre un print en cours du thread
+        principal lève "RuntimeError: reentrant call".
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handle_sigterm(signum, frame):
+            if not callable(previous):
+                # Seul le thread principal peut changer de gestionnaire ; un second SIGTERM force l'arrêt
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+            def drain_then_exit():
+                print(f"🛑 SIGTERM reçu, {self.in_flight} traitement(s) en cours")
+                if self.drain(timeout=self.drain_timeout):
+                    print("✅ Worker drainé")
+                else:
+                    print(f"⚠️ Délai de drain dépassé, {self.in_flight} job(s) repris au prochain démarrage")
+                if callable(previous):
+                    previous(signum, frame)
+                else:
+                    os.kill(os.getpid(), signal.SIGTERM)
+
+            threading.Thread(target=drain_then_exit, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def process_image_job(store, job, generate, send_image, send_message):
+    """
+    Exécute ou reprend un job /image à partir de son étape enregistrée.
+
+    generate(job) améliore, enregistre l'étape 'enhanced' puis débite via
+    record_generation (étape 'generated') ; il laisse passer JobAlreadyGenerated.
+    Un job resté à 'sending' a peut-être été livré : il est remboursé plutôt
+    que renvoyé.
+    """
+    phone, job_id = job["phone"], job["id"]
+
+    if job["step"] in ("received", "enhanced"):
+        try:
+            result = generate(job)
+        except storage.JobAlreadyGenerated:
+            # Débité par un autre worker, qui se charge aussi de l'envoi
+            print(f"ℹ️ Job {job_id} déjà généré ailleurs, rien à envoyer")
+            return
+        if not result["success"]:
+            # Message seulement si le job n'a pas été terminé ailleurs entre-temps
+            if store.update_job(phone, job_id, "failed", ("received", "enhanced")):
+                send_message(phone, result["message"])
+            return
+        job = {**job, "step": "generated", "image_url": result["image_url"],
+               "tokens_left": result["tokens_left"]}
+
+    if job["step"] == "generated":
+        # Marqué avant l'envoi : après un crash, on sait qu'il ne faut pas renvoyer
+        if not store.update_job(phone, job_id, "sending", ("generated",)):
+            return
+        caption = f"✨ *Image générée avec succès!*\n\n📝 _Prompt: {job['prompt']}_\n💰 Tokens restants: {job['tokens_left']}"
+        if send_image(phone, job["image_url"], caption):
+            store.update_job(phone, job_id, "sent", ("sending",))
+            # Message de suivi
+            if job["tokens_left"] == 0:
+                send_message(phone, "⚠️ Vous n'avez plus de tokens!\n\nTapez /recharge pour continuer")
+        elif store.refund_job(phone, job_id):
+            send_message(phone, "❌ L'image n'a pas pu être envoyée. Votre token a été remboursé.")
+        return
+
+    if job["step"] == "sending" and store.refund_job(phone, job_id):
+        print(f"↩️ Job {job_id} interrompu pendant l'envoi, token remboursé")
+        send_message(phone, "⚠️ Votre dernière génération a été interrompue. Votre token a été remboursé.")
+
+
+def recover_jobs(store, resume, older_than=JOB_RECOVERY_GRACE):
+    """Reprend les jobs abandonnés (crash, redémarrage) ; retourne leur nombre"""
+    jobs = store.claim_stale_jobs(older_than)
+    for job in jobs:
+        print(f"🔁 Reprise du job {job['id']} (étape {job['step']})")
+        try:
+            resume(job)
+        except Exception as e:
+            print(f"❌ Erreur reprise job {job['id']}: {e}")
+    return len(jobs)
+
+
+def start_recovery(lifecycle, store, resume, interval=JOB_RECOVERY_INTERVAL):
+    """Balayage au démarrage puis périodique, tant que le worker accepte du travail"""
+    def loop():
+        while lifecycle.accepting:
+            try:
+                with lifecycle.work():
+                    recover_jobs(store, resume)
+            except Draining:
+                return
+            except Exception as e:
+                print(f"⚠️ Reprise des jobs impossible: {e}")
+            with lifecycle.cond:
+                lifecycle.cond.wait_for(lambda: not lifecycle.accepting, interval)
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
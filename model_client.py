@@ -0,0 +1,210 @@
+# model_client.py - Appels Gemini avec délai, disjoncteur et requêtes doublées
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configuration
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "8"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+GEMINI_HEDGE = os.getenv("GEMINI_HEDGE", "False") == "True"
+BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+# Attente maximale d'une place libre : au-delà, repli immédiat plutôt que l'échéance complète
+GEMINI_SLOT_WAIT = float(os.getenv("GEMINI_SLOT_WAIT", "0.5"))
+
+# Échantillons minimum avant de se fier au p95 pour doubler une requête
+MIN_LATENCY_SAMPLES = 20
+# Marge du délai passé au SDK : l'échéance du client tombe d'abord et compte le dépassement,
+# puis le SDK coupe l'appel et rend sa place
+SDK_TIMEOUT_GRACE = 0.5
+
+
+class CircuitBreaker:
+    """Ouvert après N échecs consécutifs, une requête test après reset_timeout"""
+
+    def __init__(self, failure_threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_timeout:
+                # Une seule requête test par période ; les autres restent en repli
+                self.state = "half_open"
+                self.opened_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                # Un seul message à l'ouverture, pas à chaque requête test ratée
+                if self.state == "closed":
+                    print(f"⚠️ Disjoncteur Gemini ouvert après {self.failures} échec(s)")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def record_saturated(self, blocked):
+        """
+        L'appel n'a pas obtenu de place. Une requête test sans place ne
+        prouve rien : la suivante la remplace, sans rouvrir le disjoncteur.
+        Sinon, places tenues par des appels sans réponse (blocked) = échec.
+        """
+        with self.lock:
+            if self.state == "half_open":
+                self.opened_at = time.monotonic() - self.reset_timeout
+                return
+        if blocked:
+            self.record_failure()
+
+
+class ModelClient:
+    """
+    Enveloppe de GenerativeModel.generate_content.
+
+    Chaque appel a une échéance, transmise au SDK (request_options) ; en
+    cas d'échec, de délai dépassé ou de disjoncteur ouvert, generate()
+    retourne la valeur de repli. Le nombre
+    d'appels simultanés vers l'API est borné, y compris les appels
+    abandonnés qui n'ont pas encore répondu : si ce sont eux qui occupent
+    les places, l'API est bloquée et le disjoncteur compte un échec.
+    """
+
+    def __init__(self, model, timeout=GEMINI_TIMEOUT, max_concurrency=GEMINI_MAX_CONCURRENCY,
+                 hedge=GEMINI_HEDGE, breaker=None, slot_wait=GEMINI_SLOT_WAIT):
+        self.model = model
+        self.timeout = timeout
+        self.slot_wait = min(slot_wait, timeout)
+        self.hedge = hedge
+        self.breaker = breaker or CircuitBreaker()
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="gemini")
+        self.latencies = deque(maxlen=200)
+        self.abandoned = 0  # appels dépassés qui occupent encore une place
+        self.lock = threading.Lock()
+        self.counters = {"calls": 0, "successes": 0, "errors": 0, "timeouts": 0,
+                         "fallbacks": 0, "saturated": 0, "hedges": 0, "hedge_wins": 0}
+
+    def _count(self, key):
+        with self.lock:
+            self.counters[key] += 1
+
+    def _run(self, request, deadline):
+        """Exécuté dans le pool ; libère sa place même si l'appel a été abandonné"""
+        start = time.monotonic()
+        try:
+            # Échéance transmise au SDK : un appel bloqué rend sa place au lieu de la garder
+            timeout = max(deadline - start, 0) + SDK_TIMEOUT_GRACE
+            text = self.model.generate_content(request, request_options={"timeout": timeout}).text.strip()
+            with self.lock:
+                self.latencies.append(time.monotonic() - start)
+            return text
+        finally:
+            self.slots.release()
+
+    def _abandon(self, future):
+        """Compte un appel dépassé jusqu'à ce qu'il rende sa place"""
+        with self.lock:
+            self.abandoned += 1
+
+        def release(_):
+            with self.lock:
+                self.abandoned -= 1
+
+        future.add_done_callback(release)
+
+    def _percentile(self, p):
+        with self.lock:
+            samples = sorted(self.latencies)
+        if not samples:
+            return None
+        return samples[min(int(len(samples) * p), len(samples) - 1)]
+
+    def _hedge_delay(self):
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return self.timeout / 2
+        return self._percentile(0.95)
+
+    def generate(self, request, fallback):
+        """Texte généré, ou fallback si l'API est lente, en erreur ou indisponible"""
+        self._count("calls")
+
+        if not self.breaker.allow():
+            self._count("fallbacks")
+            return fallback
+
+        deadline = time.monotonic() + self.timeout
+        if not self.slots.acquire(timeout=self.slot_wait):
+            self._count("saturated")
+            self._count("fallbacks")
+            with self.lock:
+                blocked = self.abandoned > 0
+            # Places prises par des appels sans réponse : l'API est bloquée, c'est un échec.
+            # Sinon simple pic de trafic, le disjoncteur n'est pas pénalisé.
+            self.breaker.record_saturated(blocked)
+            return fallback
+
+        futures = [self.executor.submit(self._run, request, deadline)]
+
+        if self.hedge:
+            wait(futures, timeout=min(self._hedge_delay(), max(deadline - time.monotonic(), 0)))
+            if not futures[0].done() and self.slots.acquire(blocking=False):
+                self._count("hedges")
+                futures.append(self.executor.submit(self._run, request, deadline))
+
+        pending = set(futures)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not futures[0]:
+                        self._count("hedge_wins")
+                    self._count("successes")
+                    self.breaker.record_success()
+                    return future.result()
+                print(f"Erreur Gemini: {future.exception()}")
+
+        for future in pending:
+            self._abandon(future)
+        self._count("timeouts" if pending else "errors")
+        self._count("fallbacks")
+        self.breaker.record_failure()
+        return fallback
+
+    def status(self):
+        """État exposé sur / : disjoncteur, latences et compteurs"""
+        p50, p95 = self._percentile(0.5), self._percentile(0.95)
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            "breaker": self.breaker.state,
+            "healthy": self.breaker.state == "closed",
+            "consecutive_failures": self.breaker.failures,
+            "latency_p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "latency_p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "timeout_s": self.timeout,
+            "abandoned_in_flight": self.abandoned,
+            "hedging": self.hedge,
+            **counters
+        }
@@ -0,0 +1,317 @@
+# prompt_index.py - Index de prompts similaires (MinHash/LSH) pour réutiliser les générations
+import os
+import re
+import zlib
+import difflib
+import threading
+import unicodedata
+from dotenv import load_dotenv
+
+# Calcul vectorisé des signatures si numpy est disponible
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+load_dotenv()
+
+# Configuration
+PROMPT_MATCH_THRESHOLD = float(os.getenv("PROMPT_MATCH_THRESHOLD", "0.8"))
+# Prompts gardés par worker (les plus récents) : ~900 octets chacun, chargés à chaque démarrage
+PROMPT_INDEX_MAX = int(os.getenv("PROMPT_INDEX_MAX", "50000"))
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+MERSENNE_PRIME = (1 << 31) - 1
+BUILD_BATCH = 5000
+# Bucket partagé par trop de prompts (expression courante : "dans l'espace") : ignoré à la recherche
+MAX_BUCKET_SCAN = 2000
+# Deux mots différents sont une faute de frappe au-delà de ce ratio (noir / noire)
+TYPO_RATIO = 0.85
+
+# Articles et déterminants seulement : ils ne changent pas ce qui est dessiné.
+# Pas de "a" anglais : "à" devient "a" une fois les accents retirés.
+STOP_WORDS = {
+    "un", "une", "des", "du", "le", "la", "les", "l", "ce", "cet", "cette", "ces",
+    "mon", "ma", "mes", "ton", "ta", "tes", "son", "sa", "ses", "notre", "nos",
+    "votre", "vos", "leur", "leurs", "the", "an"
+}
+
+# Négations et prépositions : un ajout, un retrait ou un changement inverse le sens
+RELATION_WORDS = {
+    "sans", "avec", "sur", "sous", "pour", "dans", "devant", "derriere", "entre", "contre",
+    "vers", "chez", "avant", "apres", "a", "au", "aux", "de", "d", "en", "par", "et", "ou",
+    "ne", "pas", "non", "ni", "jamais", "aucun", "aucune", "rien", "plus",
+    "without", "with", "no", "not", "never", "on", "under", "in", "for", "behind", "and", "or"
+}
+
+
+def normalize(prompt):
+    """Minuscules sans accents ni articles ; l'ordre des mots est conservé"""
+    text = unicodedata.normalize("NFKD", prompt.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(w for w in re.findall(r"[a-z0-9]+", text) if w not in STOP_WORDS)
+
+
+def same_meaning(text, other):
+    """
+    Vérifie un candidat LSH mot à mot (prompts normalisés).
+
+    Acceptés : fautes de frappe, et des mots descriptifs ajoutés ou bien
+    retirés. Refusés : mots remplacés ou déplacés, nombres différents,
+    négations et prépositions ajoutées, retirées ou changées ("avec" /
+    "sans", "chien sur voiture" / "voiture sur chien").
+    """
+    words, other_words = text.split(), other.split()
+    removed, added = [], []
+    for op, i1, i2, j1, j2 in difflib.SequenceMatcher(None, words, other_words, autojunk=False).get_opcodes():
+        if op == "replace" and i2 - i1 == j2 - j1:
+            for a, b in zip(words[i1:i2], other_words[j1:j2]):
+                if a in RELATION_WORDS or b in RELATION_WORDS or not (a + b).isalpha():
+                    return False
+                if difflib.SequenceMatcher(None, a, b).ratio() < TYPO_RATIO:
+                    return False
+        elif op != "equal":
+            removed += words[i1:i2]
+            added += other_words[j1:j2]
+
+    if any(w in RELATION_WORDS for w in removed + added):
+        return False
+    # Retrait et ajout à la fois : un mot a été remplacé ou déplacé
+    return not (removed and added)
+
+
+def shingles(text):
+    """Hachés des n-grammes de caractères"""
+    if len(text) <= SHINGLE_SIZE:
+        return [zlib.crc32(text.encode())]
+    return list({zlib.crc32(text[i:i + SHINGLE_SIZE].encode())
+                 for i in range(len(text) - SHINGLE_SIZE + 1)})
+
+
+class PromptIndex:
+    """
+    Retrouve une génération passée dont le prompt est proche.
+
+    Chaque prompt normalisé reçoit une signature MinHash ; les bandes de la
+    signature servent de clés LSH pour trouver les candidats, puis la
+    similarité est estimée sur la signature complète. Un candidat au-dessus
+    du seuil n'est retenu que si same_meaning() l'accepte.
+
+    L'index garde au plus max_entries prompts : une fois plein, chaque
+    ajout remplace le plus ancien.
+    """
+
+    def __init__(self, threshold=PROMPT_MATCH_THRESHOLD, seed=42, max_entries=PROMPT_INDEX_MAX):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        if np is not None:
+            rng = np.random.default_rng(seed)
+            self.a = rng.integers(1, MERSENNE_PRIME, NUM_PERM, dtype=np.uint64)
+            self.b = rng.integers(0, MERSENNE_PRIME, NUM_PERM, dtype=np.uint64)
+            # Clé entière 64 bits par bande : bien plus compacte que des bytes dans un dict
+            self.band_mult = rng.integers(1, 1 << 63, ROWS, dtype=np.uint64) | np.uint64(1)
+            self.signatures = np.empty((min(1024, max_entries), NUM_PERM), dtype=np.uint32)
+        else:
+            import random
+            rng = random.Random(seed)
+            self.a = [rng.randrange(1, MERSENNE_PRIME) for _ in range(NUM_PERM)]
+            self.b = [rng.randrange(0, MERSENNE_PRIME) for _ in range(NUM_PERM)]
+            self.signatures = []
+        self.entries = []  # (enhanced_prompt, image_url)
+        self.texts = []    # prompt normalisé, pour vérifier les candidats
+        self.keys = {}     # hash du prompt normalisé -> position
+        self.buckets = [{} for _ in range(BANDS)]
+        self.oldest = 0    # prochaine position remplacée quand l'index est plein
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def signature(self, text):
+        hashes = shingles(text)
+        if np is not None:
+            h = np.asarray(hashes, dtype=np.uint64) % MERSENNE_PRIME
+            # (a * h + b) mod p pour toutes les permutations et tous les n-grammes d'un coup
+            return ((np.outer(self.a, h) + self.b[:, None]) % MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+        return [min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in zip(self.a, self.b)]
+
+    def _band_keys(self, sig):
+        if np is not None:
+            return (sig.reshape(BANDS, ROWS).astype(np.uint64) * self.band_mult).sum(axis=1).tolist()
+        return [tuple(sig[i * ROWS:(i + 1) * ROWS]) for i in range(BANDS)]
+
+    def signatures_for(self, texts):
+        """Signatures d'un lot de prompts normalisés en une seule opération matricielle"""
+        if np is None:
+            return [self.signature(text) for text in texts]
+        hashes = [shingles(text) for text in texts]
+        lengths = np.fromiter((len(h) for h in hashes), dtype=np.int64, count=len(hashes))
+        flat = np.fromiter((x for h in hashes for x in h), dtype=np.uint64, count=int(lengths.sum()))
+        values = (np.outer(self.a, flat % MERSENNE_PRIME) + self.b[:, None]) % MERSENNE_PRIME
+        # Minimum par prompt : segments contigus de la matrice
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        return np.minimum.reduceat(values, offsets, axis=1).T.astype(np.uint32)
+
+    def _evict(self, pos):
+        """Retire le prompt en position pos des clés et des buckets (sous self.lock)"""
+        key = hash(self.texts[pos])
+        if self.keys.get(key) == pos:
+            del self.keys[key]
+        for bucket, band_key in zip(self.buckets, self._band_keys(self.signatures[pos])):
+            current = bucket.get(band_key)
+            if isinstance(current, list):
+                current.remove(pos)
+                if len(current) == 1:
+                    bucket[band_key] = current[0]
+            elif current == pos:
+                del bucket[band_key]
+
+    def _insert(self, text, sig, enhanced_prompt, image_url):
+        """Appelée sous self.lock"""
+        key = hash(text)
+        known = self.keys.get(key)
+        if known is not None and self.texts[known] == text:
+            return
+
+        if len(self.entries) < self.max_entries:
+            pos = len(self.entries)
+            self.entries.append(None)
+            self.texts.append(None)
+            if np is not None:
+                if pos == len(self.signatures):
+                    grow = min(pos, self.max_entries - pos)
+                    self.signatures = np.concatenate([self.signatures, np.empty((grow, NUM_PERM), np.uint32)])
+            else:
+                self.signatures.append(None)
+        else:
+            # Index plein : le plus ancien prompt laisse sa place
+            pos = self.oldest
+            self.oldest = (pos + 1) % self.max_entries
+            self._evict(pos)
+
+        self.entries[pos] = (enhanced_prompt, image_url)
+        self.texts[pos] = text
+        self.signatures[pos] = sig
+        # Collision de hash() : la clé reste au premier prompt, celui-ci n'est trouvé que par LSH
+        if key not in self.keys:
+            self.keys[key] = pos
+
+        for bucket, key in zip(self.buckets, self._band_keys(sig)):
+            # Un seul id par clé pour économiser la mémoire, une liste au-delà
+            current = bucket.get(key)
+            if current is None:
+                bucket[key] = pos
+            elif isinstance(current, list):
+                current.append(pos)
+            else:
+                bucket[key] = [current, pos]
+
+    def add(self, prompt, enhanced_prompt, image_url):
+        """Ajoute une génération ; un prompt normalisé déjà indexé n'est pas dupliqué"""
+        text = normalize(prompt)
+        if not text:
+            return
+        sig = self.signature(text)
+        with self.lock:
+            self._insert(text, sig, enhanced_prompt, image_url)
+
+    def add_many(self, rows):
+        """Ajout en lot de (prompt, enhanced_prompt, image_url)"""
+        rows = [(normalize(prompt), enhanced, url) for prompt, enhanced, url in rows]
+        rows = [row for row in rows if row[0]]
+        if not rows:
+            return
+        sigs = self.signatures_for([text for text, _, _ in rows])
+        with self.lock:
+            for (text, enhanced, url), sig in zip(rows, sigs):
+                self._insert(text, sig, enhanced, url)
+
+    def lookup(self, prompt):
+        """(enhanced_prompt, image_url, similarité) du meilleur voisin, ou None"""
+        text = normalize(prompt)
+        if not text:
+            return None
+
+        with self.lock:
+            pos = self.keys.get(hash(text))
+            # Un hash égal ne suffit pas : deux prompts différents peuvent entrer en collision
+            if pos is not None and self.texts[pos] == text:
+                return (*self.entries[pos], 1.0)
+
+        sig = self.signature(text)
+        candidates = set()
+        with self.lock:
+            for bucket, key in zip(self.buckets, self._band_keys(sig)):
+                found = bucket.get(key)
+                if found is None:
+                    continue
+                if isinstance(found, list):
+                    if len(found) > MAX_BUCKET_SCAN:
+                        continue
+                    candidates.update(found)
+                else:
+                    candidates.add(found)
+            if not candidates:
+                return None
+
+            ids = sorted(candidates)
+            if np is not None:
+                scores = (self.signatures[ids] == sig).mean(axis=1).tolist()
+            else:
+                scores = [sum(x == y for x, y in zip(self.signatures[i], sig)) / NUM_PERM for i in ids]
+            ranked = sorted(((score, pos) for score, pos in zip(scores, ids) if score >= self.threshold),
+                            reverse=True)
+            ranked = [(score, self.texts[pos], self.entries[pos]) for score, pos in ranked]
+
+        # Meilleur candidat qui décrit la même image
+        for score, candidate, entry in ranked:
+            if same_meaning(text, candidate):
+                return (*entry, score)
+        return None
+
+    def memory_bytes(self):
+        """Taille approximative des signatures (hors dictionnaires et textes Python)"""
+        if np is not None:
+            return self.signatures[:len(self.entries)].nbytes
+        return len(self.signatures) * NUM_PERM * 8
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Index partagé par le processus"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = PromptIndex()
+        return _index
+
+
+def build_from_storage(store, index=None):
+    """Charge les générations les plus récentes dans l'index (au plus index.max_entries)"""
+    index = get_index() if index is None else index
+    # Les replis (prompt non amélioré) ne sont pas réutilisés
+    rows = [row for row in store.iter_recent_generations(index.max_entries) if row[1] and row[1] != row[0]]
+    # Du plus ancien au plus récent : les ajouts suivants remplacent d'abord les plus anciens
+    rows.reverse()
+    for i in range(0, len(rows), BUILD_BATCH):
+        index.add_many(rows[i:i + BUILD_BATCH])
+    print(f"🔎 Index de prompts: {len(index)} prompts distincts ({len(rows)} générations récentes)")
+    return index
+
+
+def start_build(store):
+    """Chargement en arrière-plan : les recherches ratent seulement pendant la construction"""
+    def build():
+        try:
+            build_from_storage(store)
+        except Exception as e:
+            print(f"⚠️ Index de prompts non chargé: {e}")
+
+    thread = threading.Thread(target=build, daemon=True)
+    thread.start()
+    return thread
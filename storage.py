@@ -0,0 +1,1101 @@
+# storage.py - Stockage des utilisateurs et générations (SQLite shardé ou Postgres)
+import os
+import time
+import uuid
+import zlib
+import heapq
+import queue
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+import analytics
+
+load_dotenv()
+
+# Configuration
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+DB_PATH = os.getenv("DB_PATH", "imagegenie.db")
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+# Attente maximale d'une connexion libre (le pool psycopg2 lève PoolError au lieu d'attendre)
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DATABASE_URL = os.getenv("DATABASE_URL")
+MIGRATION_CHUNK = 5000
+# Plus grand id possible (INTEGER SQLite, BIGSERIAL Postgres) : point de départ des lectures décroissantes
+MAX_ROW_ID = (1 << 63) - 1
+
+# Étapes d'un job /image : received -> enhanced -> generated -> sending -> sent
+# (ou failed avant débit, refunded après débit)
+OPEN_JOB_STEPS = ("received", "enhanced", "generated", "sending")
+JOB_FIELDS = ("id", "phone", "prompt", "step", "enhanced_prompt", "image_url", "tokens_left")
+BROADCAST_FIELDS = ("id", "message", "template", "language", "status", "last_phone", "sent", "failed",
+                    "created_at", "finished_at")
+
+
+class JobAlreadyGenerated(ValueError):
+    """Le job a déjà été débité (reprise concurrente) : la suite est gérée ailleurs"""
+
+
+class Storage:
+    """
+    Opérations sur users/generations utilisées par le bot.
+
+    Chaque backend garantit que le débit d'un token, l'insertion de la
+    génération et la mise à jour des agrégats sont atomiques.
+    """
+
+    def init(self):
+        """Crée les tables si nécessaire"""
+        raise NotImplementedError
+
+    def get_or_create_user(self, phone):
+        """Retourne (tokens, total_generated), crée l'utilisateur avec 1 token"""
+        raise NotImplementedError
+
+    def record_generation(self, phone, prompt, enhanced_prompt, image_url, job_id=None):
+        """
+        Débite un token et enregistre la génération ; None si crédit insuffisant.
+
+        Avec job_id, le job passe à l'étape 'generated' dans la même
+        transaction ; JobAlreadyGenerated s'il a déjà dépassé cette étape.
+        """
+        raise NotImplementedError
+
+    def create_job(self, phone, prompt, job_id=None):
+        """
+        Enregistre un job /image à l'étape 'received' et retourne son id.
+
+        job_id est l'id du message WhatsApp : un webhook renvoyé par Meta ne
+        crée pas de second job, create_job retourne alors None.
+        """
+        raise NotImplementedError
+
+    def update_job(self, phone, job_id, step, from_steps, enhanced_prompt=None, image_url=None):
+        """Passe le job à step s'il est dans from_steps ; False sinon"""
+        raise NotImplementedError
+
+    def refund_job(self, phone, job_id):
+        """Rend le token d'un job débité mais non livré ; False si déjà traité"""
+        raise NotImplementedError
+
+    def claim_stale_jobs(self, older_than):
+        """Jobs non terminés inactifs depuis older_than secondes, réservés pour reprise"""
+        raise NotImplementedError
+
+    def create_broadcast(self, message, template=None, language=None):
+        """
+        Enregistre une campagne à l'état 'pending' et retourne son id.
+
+        Avec template (modèle approuvé par Meta), message est passé en
+        paramètre du corps au lieu d'être envoyé en texte libre.
+        """
+        raise NotImplementedError
+
+    def get_broadcast(self, broadcast_id):
+        """Campagne en dict (BROADCAST_FIELDS), None si introuvable"""
+        raise NotImplementedError
+
+    def claim_broadcast(self, broadcast_id, stale_before):
+        """
+        Passe la campagne à 'running' ; False si elle est terminée ou si
+        une autre instance l'envoie (checkpoint postérieur à stale_before).
+        """
+        raise NotImplementedError
+
+    def checkpoint_broadcast(self, broadcast_id, last_phone, results):
+        """
+        Enregistre les résultats (phone, succès, status_code, erreur) d'une
+        page et le point de reprise en une transaction. Retourne True si une
+        pause a été demandée, quelle que soit l'instance qui l'a demandée.
+        """
+        raise NotImplementedError
+
+    def request_broadcast_stop(self, broadcast_id):
+        """Demande la pause d'une campagne 'running' ; False si elle ne tourne pas"""
+        raise NotImplementedError
+
+    def finish_broadcast(self, broadcast_id, status):
+        """Fin d'un envoi : 'done' ou 'paused' (reprenable)"""
+        raise NotImplementedError
+
+    def count_broadcast_recipients(self, since):
+        """Numéros distincts joints par une campagne depuis since (limite quotidienne Meta)"""
+        raise NotImplementedError
+
+    def count_users(self):
+        raise NotImplementedError
+
+    def iter_phones(self, after_phone="", page_size=500):
+        """Pages de numéros triés, à partir de after_phone exclu (pagination keyset)"""
+        raise NotImplementedError
+
+    def iter_generations(self, chunk_size=MIGRATION_CHUNK):
+        """Toutes les générations (prompt, enhanced_prompt, image_url), par tranches"""
+        raise NotImplementedError
+
+    def iter_recent_generations(self, limit, chunk_size=MIGRATION_CHUNK):
+        """Les limit dernières générations (prompt, enhanced_prompt, image_url), la plus récente d'abord"""
+        raise NotImplementedError
+
+    def get_stats(self, days=30, limit=10):
+        """Statistiques d'usage lues dans les agrégats"""
+        raise NotImplementedError
+
+    def import_users(self, rows):
+        """Import en masse de (phone, tokens, total_generated, created_at)"""
+        raise NotImplementedError
+
+    def import_generations(self, rows):
+        """Import en masse de (phone, prompt, enhanced_prompt, image_url, created_at)"""
+        raise NotImplementedError
+
+    def count_generations(self):
+        raise NotImplementedError
+
+    def rebuild_stats(self):
+        """Recalcule les agrégats après un import"""
+        raise NotImplementedError
+
+
+class _SqlitePool:
+    """Pool de connexions vers un fichier SQLite (mode WAL)"""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.created < self.size
+                if can_open:
+                    self.created += 1
+            conn = self._open() if can_open else self.idle.get()
+
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.idle.put(conn)
+
+
+def shard_paths(db_path=DB_PATH, shards=DB_SHARDS):
+    """Un seul shard garde le fichier historique, sinon imagegenie.0.db, imagegenie.1.db..."""
+    if shards <= 1:
+        return [db_path]
+    base, ext = os.path.splitext(db_path)
+    return [f"{base}.{i}{ext}" for i in range(shards)]
+
+
+class SqliteShardedStorage(Storage):
+    """Utilisateurs répartis par hachage du numéro sur N fichiers SQLite"""
+
+    def __init__(self, paths, pool_size=DB_POOL_SIZE):
+        self.paths = list(paths)
+        self.pools = [_SqlitePool(path, pool_size) for path in self.paths]
+
+    def _shard(self, phone):
+        # crc32 : stable entre processus, contrairement à hash()
+        return zlib.crc32(phone.encode()) % len(self.pools)
+
+    def _pool(self, phone):
+        return self.pools[self._shard(phone)]
+
+    def _import(self, sql, rows):
+        by_shard = [[] for _ in self.pools]
+        for row in rows:
+            by_shard[self._shard(row[0])].append(row)
+        for pool, shard_rows in zip(self.pools, by_shard):
+            if shard_rows:
+                with pool.connection() as conn:
+                    conn.executemany(sql, shard_rows)
+                    conn.commit()
+
+    def init(self):
+        for pool in self.pools:
+            with pool.connection() as conn:
+                c = conn.cursor()
+
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS users (
+                        phone TEXT PRIMARY KEY,
+                        tokens INTEGER DEFAULT 1,
+                        total_generated INTEGER DEFAULT 0,
+                        created_at TIMESTAMP
+                    )
+                ''')
+
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS generations (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        phone TEXT,
+                        prompt TEXT,
+                        enhanced_prompt TEXT,
+                        image_url TEXT,
+                        created_at TIMESTAMP
+                    )
+                ''')
+
+                # Jobs /image en cours, pour reprise après redémarrage
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        id TEXT PRIMARY KEY,
+                        phone TEXT,
+                        prompt TEXT,
+                        step TEXT,
+                        enhanced_prompt TEXT,
+                        image_url TEXT,
+                        tokens_left INTEGER,
+                        created_at TIMESTAMP,
+                        updated_at REAL
+                    )
+                ''')
+                c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_step ON jobs (step, updated_at)")
+
+                conn.commit()
+                analytics.init_analytics_db(conn)
+
+        # Campagnes : un seul exemplaire, dans le premier shard
+        with self.pools[0].connection() as conn:
+            c = conn.cursor()
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message TEXT,
+                    template TEXT,
+                    language TEXT,
+                    status TEXT DEFAULT 'pending',
+                    last_phone TEXT DEFAULT '',
+                    sent INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    created_at TIMESTAMP,
+                    heartbeat_at TIMESTAMP,
+                    finished_at TIMESTAMP,
+                    stop_requested INTEGER DEFAULT 0
+                )
+            ''')
+            # Table créée par une version précédente de broadcast.py
+            columns = [row[1] for row in c.execute("PRAGMA table_info(broadcasts)")]
+            for column in ("template TEXT", "language TEXT", "stop_requested INTEGER DEFAULT 0"):
+                if column.split()[0] not in columns:
+                    c.execute(f"ALTER TABLE broadcasts ADD COLUMN {column}")
+
+            # Clé (broadcast_id, phone) : une reprise ne duplique pas les lignes
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_results (
+                    broadcast_id INTEGER,
+                    phone TEXT,
+                    success INTEGER,
+                    status_code INTEGER,
+                    error TEXT,
+                    sent_at TIMESTAMP,
+                    PRIMARY KEY (broadcast_id, phone)
+                )
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_results_sent ON broadcast_results (sent_at)")
+
+            conn.commit()
+
+    def get_or_create_user(self, phone):
+        with self._pool(phone).connection() as conn:
+            c = conn.cursor()
+            c.execute("INSERT OR IGNORE INTO users (phone, tokens, created_at) VALUES (?, 1, ?)",
+                      (phone, datetime.now()))
+            conn.commit()
+            c.execute("SELECT tokens, total_generated FROM users WHERE phone = ?", (phone,))
+            return c.fetchone()
+
+    def record_generation(self, phone, prompt, enhanced_prompt, image_url, job_id=None):
+        with self._pool(phone).connection() as conn:
+            c = conn.cursor()
+
+            # Un job ne peut être débité qu'une fois, même s'il est repris
+            if job_id:
+                c.execute("""
+                    UPDATE jobs SET step = 'generated', enhanced_prompt = ?, image_url = ?, updated_at = ?
+                    WHERE id = ? AND step IN ('received', 'enhanced')
+                """, (enhanced_prompt, image_url, time.time(), job_id))
+                if c.rowcount == 0:
+                    conn.rollback()
+                    raise JobAlreadyGenerated(f"Job {job_id} déjà généré")
+
+            # Débit conditionnel : deux requêtes simultanées ne passent pas sous 0
+            c.execute("""
+                UPDATE users SET tokens = tokens - 1, total_generated = total_generated + 1
+                WHERE phone = ? AND tokens >= 1
+            """, (phone,))
+            if c.rowcount == 0:
+                conn.rollback()
+                return None
+
+            created_at = datetime.now()
+            c.execute("""
+                INSERT INTO generations (phone, prompt, enhanced_prompt, image_url, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (phone, prompt, enhanced_prompt, image_url, created_at))
+
+            # Agrégats mis à jour dans la même transaction
+            analytics.record_generation(c, c.lastrowid, phone, prompt, created_at)
+
+            c.execute("SELECT tokens FROM users WHERE phone = ?", (phone,))
+            tokens = c.fetchone()[0]
+            if job_id:
+                c.execute("UPDATE jobs SET tokens_left = ? WHERE id = ?", (tokens, job_id))
+            conn.commit()
+            return tokens
+
+    def create_job(self, phone, prompt, job_id=None):
+        job_id = job_id or uuid.uuid4().hex
+        with self._pool(phone).connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                INSERT OR IGNORE INTO jobs (id, phone, prompt, step, created_at, updated_at)
+                VALUES (?, ?, ?, 'received', ?, ?)
+            """, (job_id, phone, prompt, datetime.now(), time.time()))
+            conn.commit()
+            return job_id if c.rowcount == 1 else None
+
+    def update_job(self, phone, job_id, step, from_steps, enhanced_prompt=None, image_url=None):
+        with self._pool(phone).connection() as conn:
+            c = conn.cursor()
+            c.execute(f"""
+                UPDATE jobs SET step = ?, enhanced_prompt = COALESCE(?, enhanced_prompt),
+                                image_url = COALESCE(?, image_url), updated_at = ?
+                WHERE id = ? AND step IN ({",".join("?" * len(from_steps))})
+            """, (step, enhanced_prompt, image_url, time.time(), job_id, *from_steps))
+            conn.commit()
+            return c.rowcount == 1
+
+    def refund_job(self, phone, job_id):
+        with self._pool(phone).connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                UPDATE jobs SET step = 'refunded', updated_at = ?
+                WHERE id = ? AND step IN ('generated', 'sending')
+            """, (time.time(), job_id))
+            if c.rowcount == 0:
+                conn.rollback()
+                return False
+            c.execute("UPDATE users SET tokens = tokens + 1 WHERE phone = ?", (phone,))
+            conn.commit()
+            return True
+
+    def claim_stale_jobs(self, older_than):
+        now = time.time()
+        claimed = []
+        for pool in self.pools:
+            with pool.connection() as conn:
+                c = conn.cursor()
+                c.execute(f"""
+                    SELECT {", ".join(JOB_FIELDS)}, updated_at FROM jobs
+                    WHERE step IN ({",".join("?" * len(OPEN_JOB_STEPS))}) AND updated_at < ?
+                """, (*OPEN_JOB_STEPS, now - older_than))
+                for row in c.fetchall():
+                    # Réservation conditionnelle : un seul worker reprend le job
+                    c.execute("UPDATE jobs SET updated_at = ? WHERE id = ? AND updated_at = ?",
+                              (now, row[0], row[-1]))
+                    if c.rowcount == 1:
+                        claimed.append(dict(zip(JOB_FIELDS, row)))
+                conn.commit()
+        return claimed
+
+    def create_broadcast(self, message, template=None, language=None):
+        with self.pools[0].connection() as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO broadcasts (message, template, language, created_at) VALUES (?, ?, ?, ?)",
+                      (message, template, language, datetime.now()))
+            conn.commit()
+            return c.lastrowid
+
+    def get_broadcast(self, broadcast_id):
+        with self.pools[0].connection() as conn:
+            row = conn.execute(f"""SELECT {", ".join(BROADCAST_FIELDS)} FROM broadcasts WHERE id = ?""",
+                               (broadcast_id,)).fetchone()
+        return dict(zip(BROADCAST_FIELDS, row)) if row else None
+
+    def claim_broadcast(self, broadcast_id, stale_before):
+        with self.pools[0].connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                UPDATE broadcasts SET status = 'running', heartbeat_at = ?, stop_requested = 0
+                WHERE id = ? AND status != 'done'
+                AND (status != 'running' OR heartbeat_at IS NULL OR heartbeat_at < ?)
+            """, (datetime.now(), broadcast_id, stale_before))
+            conn.commit()
+            return c.rowcount == 1
+
+    def checkpoint_broadcast(self, broadcast_id, last_phone, results):
+        now = datetime.now()
+        sent = sum(1 for r in results if r[1])
+        with self.pools[0].connection() as conn:
+            c = conn.cursor()
+            c.executemany("""
+                INSERT OR REPLACE INTO broadcast_results
+                (broadcast_id, phone, success, status_code, error, sent_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [(broadcast_id, phone, int(ok), code, err, now) for phone, ok, code, err in results])
+            c.execute("""
+                UPDATE broadcasts SET last_phone = ?, sent = sent + ?, failed = failed + ?, heartbeat_at = ?
+                WHERE id = ?
+            """, (last_phone, sent, len(results) - sent, now, broadcast_id))
+            c.execute("SELECT stop_requested FROM broadcasts WHERE id = ?", (broadcast_id,))
+            stop_requested = c.fetchone()[0]
+            conn.commit()
+            return bool(stop_requested)
+
+    def request_broadcast_stop(self, broadcast_id):
+        with self.pools[0].connection() as conn:
+            c = conn.cursor()
+            c.execute("UPDATE broadcasts SET stop_requested = 1 WHERE id = ? AND status = 'running'",
+                      (broadcast_id,))
+            conn.commit()
+            return c.rowcount == 1
+
+    def finish_broadcast(self, broadcast_id, status):
+        with self.pools[0].connection() as conn:
+            conn.execute("UPDATE broadcasts SET status = ?, finished_at = ?, stop_requested = 0 WHERE id = ?",
+                         (status, datetime.now() if status == "done" else None, broadcast_id))
+            conn.commit()
+
+    def count_broadcast_recipients(self, since):
+        with self.pools[0].connection() as conn:
+            return conn.execute("""
+                SELECT COUNT(DISTINCT phone) FROM broadcast_results WHERE success = 1 AND sent_at >= ?
+            """, (since,)).fetchone()[0]
+
+    def count_users(self):
+        total = 0
+        for pool in self.pools:
+            with pool.connection() as conn:
+                total += conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        return total
+
+    def _iter_shard(self, pool, after_phone, page_size):
+        while True:
+            with pool.connection() as conn:
+                rows = conn.execute("SELECT phone FROM users WHERE phone > ? ORDER BY phone LIMIT ?",
+                                    (after_phone, page_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[0]
+            after_phone = rows[-1][0]
+
+    def iter_phones(self, after_phone="", page_size=500):
+        # Fusion triée des shards : l'ordre global permet de reprendre après un numéro
+        phones = heapq.merge(*(self._iter_shard(pool, after_phone, page_size) for pool in self.pools))
+        page = []
+        for phone in phones:
+            page.append(phone)
+            if len(page) == page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def iter_generations(self, chunk_size=MIGRATION_CHUNK):
+        for pool in self.pools:
+            after = 0
+            while True:
+                with pool.connection() as conn:
+                    rows = conn.execute("""
+                        SELECT id, prompt, enhanced_prompt, image_url FROM generations
+                        WHERE id > ? ORDER BY id LIMIT ?
+                    """, (after, chunk_size)).fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[1:]
+                after = rows[-1][0]
+
+    def _iter_shard_recent(self, pool, limit, chunk_size):
+        after = MAX_ROW_ID
+        while limit > 0:
+            with pool.connection() as conn:
+                rows = conn.execute("""
+                    SELECT id, created_at, prompt, enhanced_prompt, image_url FROM generations
+                    WHERE id < ? ORDER BY id DESC LIMIT ?
+                """, (after, min(chunk_size, limit))).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[1:]
+            limit -= len(rows)
+            after = rows[-1][0]
+
+    def iter_recent_generations(self, limit, chunk_size=MIGRATION_CHUNK):
+        # Fusion des shards par date décroissante ; chacun fournit au plus limit lignes
+        rows = heapq.merge(*(self._iter_shard_recent(pool, limit, chunk_size) for pool in self.pools),
+                           key=lambda row: row[0] or "", reverse=True)
+        for _, row in zip(range(limit), rows):
+            yield row[1:]
+
+    def get_stats(self, days=30, limit=10):
+        return analytics.get_stats(self.paths, days=days, limit=limit)
+
+    def import_users(self, rows):
+        self._import("""
+            INSERT OR IGNORE INTO users (phone, tokens, total_generated, created_at)
+            VALUES (?, ?, ?, ?)
+        """, rows)
+
+    def import_generations(self, rows):
+        self._import("""
+            INSERT INTO generations (phone, prompt, enhanced_prompt, image_url, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, rows)
+
+    def count_generations(self):
+        total = 0
+        for pool in self.pools:
+            with pool.connection() as conn:
+                total += conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+        return total
+
+    def rebuild_stats(self):
+        for path in self.paths:
+            analytics.backfill(path)
+
+
+class PostgresStorage(Storage):
+    """Backend Postgres (DATABASE_URL), agrégats maintenus dans la même transaction"""
+
+    def __init__(self, dsn=DATABASE_URL, pool_size=DB_POOL_SIZE, pool_timeout=DB_POOL_TIMEOUT):
+        import psycopg2.pool
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size, dsn)
+        # Une place par connexion : les threads en trop attendent au lieu de recevoir PoolError
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.pool_timeout = pool_timeout
+
+    @contextmanager
+    def _connection(self):
+        if not self.slots.acquire(timeout=self.pool_timeout):
+            raise TimeoutError(f"Aucune connexion Postgres libre après {self.pool_timeout}s")
+        try:
+            conn = self.pool.getconn()
+            try:
+                yield conn
+            finally:
+                # Toujours rendue hors transaction, y compris après une simple lecture
+                broken = bool(conn.closed)
+                if not broken:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        broken = True
+                self.pool.putconn(conn, close=broken)
+        finally:
+            self.slots.release()
+
+    def init(self):
+        with self._connection() as conn:
+            c = conn.cursor()
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    phone TEXT PRIMARY KEY,
+                    tokens INTEGER DEFAULT 1,
+                    total_generated INTEGER DEFAULT 0,
+                    created_at TIMESTAMP
+                )
+            ''')
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS generations (
+                    id BIGSERIAL PRIMARY KEY,
+                    phone TEXT,
+                    prompt TEXT,
+                    enhanced_prompt TEXT,
+                    image_url TEXT,
+                    created_at TIMESTAMP
+                )
+            ''')
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS daily_user_stats (
+                    day TEXT,
+                    phone TEXT,
+                    images INTEGER DEFAULT 0,
+                    PRIMARY KEY (day, phone)
+                )
+            ''')
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS daily_stats (
+                    day TEXT PRIMARY KEY,
+                    images INTEGER DEFAULT 0,
+                    active_users INTEGER DEFAULT 0
+                )
+            ''')
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS prompt_stats (
+                    prompt TEXT PRIMARY KEY,
+                    uses INTEGER DEFAULT 0,
+                    last_used TIMESTAMP
+                )
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_prompt_stats_uses ON prompt_stats (uses)")
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    phone TEXT,
+                    prompt TEXT,
+                    step TEXT,
+                    enhanced_prompt TEXT,
+                    image_url TEXT,
+                    tokens_left INTEGER,
+                    created_at TIMESTAMP,
+                    updated_at DOUBLE PRECISION
+                )
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_step ON jobs (step, updated_at)")
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id SERIAL PRIMARY KEY,
+                    message TEXT,
+                    template TEXT,
+                    language TEXT,
+                    status TEXT DEFAULT 'pending',
+                    last_phone TEXT DEFAULT '',
+                    sent INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    created_at TIMESTAMP,
+                    heartbeat_at TIMESTAMP,
+                    finished_at TIMESTAMP,
+                    stop_requested BOOLEAN DEFAULT FALSE
+                )
+            ''')
+
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_results (
+                    broadcast_id INTEGER,
+                    phone TEXT,
+                    success BOOLEAN,
+                    status_code INTEGER,
+                    error TEXT,
+                    sent_at TIMESTAMP,
+                    PRIMARY KEY (broadcast_id, phone)
+                )
+            ''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_results_sent ON broadcast_results (sent_at)")
+
+            conn.commit()
+
+    def get_or_create_user(self, phone):
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO users (phone, tokens, created_at) VALUES (%s, 1, %s) "
+                      "ON CONFLICT (phone) DO NOTHING", (phone, datetime.now()))
+            c.execute("SELECT tokens, total_generated FROM users WHERE phone = %s", (phone,))
+            row = c.fetchone()
+            conn.commit()
+            return row
+
+    def _apply_stats(self, c, phone, prompt, created_at):
+        day = created_at.strftime("%Y-%m-%d")
+
+        # xmax = 0 : la ligne vient d'être insérée, nouvel utilisateur actif du jour
+        c.execute("""
+            INSERT INTO daily_user_stats (day, phone, images) VALUES (%s, %s, 1)
+            ON CONFLICT (day, phone) DO UPDATE SET images = daily_user_stats.images + 1
+            RETURNING (xmax = 0)
+        """, (day, phone))
+        new_user = 1 if c.fetchone()[0] else 0
+
+        c.execute("""
+            INSERT INTO daily_stats (day, images, active_users) VALUES (%s, 1, %s)
+            ON CONFLICT (day) DO UPDATE SET images = daily_stats.images + 1,
+                                            active_users = daily_stats.active_users + excluded.active_users
+        """, (day, new_user))
+
+        c.execute("""
+            INSERT INTO prompt_stats (prompt, uses, last_used) VALUES (%s, 1, %s)
+            ON CONFLICT (prompt) DO UPDATE SET uses = prompt_stats.uses + 1,
+                                               last_used = GREATEST(prompt_stats.last_used, excluded.last_used)
+        """, (analytics.normalize_prompt(prompt), created_at))
+
+    def record_generation(self, phone, prompt, enhanced_prompt, image_url, job_id=None):
+        with self._connection() as conn:
+            c = conn.cursor()
+
+            if job_id:
+                c.execute("""
+                    UPDATE jobs SET step = 'generated', enhanced_prompt = %s, image_url = %s, updated_at = %s
+                    WHERE id = %s AND step IN ('received', 'enhanced')
+                """, (enhanced_prompt, image_url, time.time(), job_id))
+                if c.rowcount == 0:
+                    conn.rollback()
+                    raise JobAlreadyGenerated(f"Job {job_id} déjà généré")
+
+            c.execute("""
+                UPDATE users SET tokens = tokens - 1, total_generated = total_generated + 1
+                WHERE phone = %s AND tokens >= 1 RETURNING tokens
+            """, (phone,))
+            row = c.fetchone()
+            if not row:
+                conn.rollback()
+                return None
+
+            created_at = datetime.now()
+            c.execute("""
+                INSERT INTO generations (phone, prompt, enhanced_prompt, image_url, created_at)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (phone, prompt, enhanced_prompt, image_url, created_at))
+
+            self._apply_stats(c, phone, prompt, created_at)
+
+            if job_id:
+                c.execute("UPDATE jobs SET tokens_left = %s WHERE id = %s", (row[0], job_id))
+
+            conn.commit()
+            return row[0]
+
+    def create_job(self, phone, prompt, job_id=None):
+        job_id = job_id or uuid.uuid4().hex
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                INSERT INTO jobs (id, phone, prompt, step, created_at, updated_at)
+                VALUES (%s, %s, %s, 'received', %s, %s)
+                ON CONFLICT (id) DO NOTHING
+            """, (job_id, phone, prompt, datetime.now(), time.time()))
+            conn.commit()
+            return job_id if c.rowcount == 1 else None
+
+    def update_job(self, phone, job_id, step, from_steps, enhanced_prompt=None, image_url=None):
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                UPDATE jobs SET step = %s, enhanced_prompt = COALESCE(%s, enhanced_prompt),
+                                image_url = COALESCE(%s, image_url), updated_at = %s
+                WHERE id = %s AND step = ANY(%s)
+            """, (step, enhanced_prompt, image_url, time.time(), job_id, list(from_steps)))
+            conn.commit()
+            return c.rowcount == 1
+
+    def refund_job(self, phone, job_id):
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                UPDATE jobs SET step = 'refunded', updated_at = %s
+                WHERE id = %s AND step IN ('generated', 'sending')
+            """, (time.time(), job_id))
+            if c.rowcount == 0:
+                conn.rollback()
+                return False
+            c.execute("UPDATE users SET tokens = tokens + 1 WHERE phone = %s", (phone,))
+            conn.commit()
+            return True
+
+    def claim_stale_jobs(self, older_than):
+        now = time.time()
+        with self._connection() as conn:
+            c = conn.cursor()
+            # SKIP LOCKED : plusieurs instances peuvent balayer en même temps
+            c.execute(f"""
+                UPDATE jobs SET updated_at = %s
+                WHERE id IN (
+                    SELECT id FROM jobs WHERE step = ANY(%s) AND updated_at < %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING {", ".join(JOB_FIELDS)}
+            """, (now, list(OPEN_JOB_STEPS), now - older_than))
+            claimed = [dict(zip(JOB_FIELDS, row)) for row in c.fetchall()]
+            conn.commit()
+            return claimed
+
+    def create_broadcast(self, message, template=None, language=None):
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                INSERT INTO broadcasts (message, template, language, created_at) VALUES (%s, %s, %s, %s)
+                RETURNING id
+            """, (message, template, language, datetime.now()))
+            broadcast_id = c.fetchone()[0]
+            conn.commit()
+            return broadcast_id
+
+    def get_broadcast(self, broadcast_id):
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute(f"""SELECT {", ".join(BROADCAST_FIELDS)} FROM broadcasts WHERE id = %s""", (broadcast_id,))
+            row = c.fetchone()
+        return dict(zip(BROADCAST_FIELDS, row)) if row else None
+
+    def claim_broadcast(self, broadcast_id, stale_before):
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("""
+                UPDATE broadcasts SET status = 'running', heartbeat_at = %s, stop_requested = FALSE
+                WHERE id = %s AND status != 'done'
+                AND (status != 'running' OR heartbeat_at IS NULL OR heartbeat_at < %s)
+            """, (datetime.now(), broadcast_id, stale_before))
+            conn.commit()
+            return c.rowcount == 1
+
+    def checkpoint_broadcast(self, broadcast_id, last_phone, results):
+        from psycopg2.extras import execute_values
+        now = datetime.now()
+        sent = sum(1 for r in results if r[1])
+        with self._connection() as conn:
+            c = conn.cursor()
+            execute_values(c, """
+                INSERT INTO broadcast_results (broadcast_id, phone, success, status_code, error, sent_at) VALUES %s
+                ON CONFLICT (broadcast_id, phone) DO UPDATE SET
+                    success = excluded.success, status_code = excluded.status_code,
+                    error = excluded.error, sent_at = excluded.sent_at
+            """, [(broadcast_id, phone, ok, code, err, now) for phone, ok, code, err in results])
+            c.execute("""
+                UPDATE broadcasts SET last_phone = %s, sent = sent + %s, failed = failed + %s, heartbeat_at = %s
+                WHERE id = %s RETURNING stop_requested
+            """, (last_phone, sent, len(results) - sent, now, broadcast_id))
+            stop_requested = c.fetchone()[0]
+            conn.commit()
+            return stop_requested
+
+    def request_broadcast_stop(self, broadcast_id):
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("UPDATE broadcasts SET stop_requested = TRUE WHERE id = %s AND status = 'running'",
+                      (broadcast_id,))
+            conn.commit()
+            return c.rowcount == 1
+
+    def finish_broadcast(self, broadcast_id, status):
+        with self._connection() as conn:
+            conn.cursor().execute("""
+                UPDATE broadcasts SET status = %s, finished_at = %s, stop_requested = FALSE WHERE id = %s
+            """, (status, datetime.now() if status == "done" else None, broadcast_id))
+            conn.commit()
+
+    def count_broadcast_recipients(self, since):
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT COUNT(DISTINCT phone) FROM broadcast_results WHERE success AND sent_at >= %s",
+                      (since,))
+            return c.fetchone()[0]
+
+    def count_users(self):
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT COUNT(*) FROM users")
+            return c.fetchone()[0]
+
+    def iter_phones(self, after_phone="", page_size=500):
+        while True:
+            with self._connection() as conn:
+                c = conn.cursor()
+                c.execute("SELECT phone FROM users WHERE phone > %s ORDER BY phone LIMIT %s",
+                          (after_phone, page_size))
+                page = [row[0] for row in c.fetchall()]
+            if not page:
+                return
+            yield page
+            after_phone = page[-1]
+
+    def iter_generations(self, chunk_size=MIGRATION_CHUNK):
+        after = 0
+        while True:
+            with self._connection() as conn:
+                c = conn.cursor()
+                c.execute("""
+                    SELECT id, prompt, enhanced_prompt, image_url FROM generations
+                    WHERE id > %s ORDER BY id LIMIT %s
+                """, (after, chunk_size))
+                rows = c.fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[1:]
+            after = rows[-1][0]
+
+    def iter_recent_generations(self, limit, chunk_size=MIGRATION_CHUNK):
+        after = MAX_ROW_ID
+        while limit > 0:
+            with self._connection() as conn:
+                c = conn.cursor()
+                c.execute("""
+                    SELECT id, prompt, enhanced_prompt, image_url FROM generations
+                    WHERE id < %s ORDER BY id DESC LIMIT %s
+                """, (after, min(chunk_size, limit)))
+                rows = c.fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[1:]
+            limit -= len(rows)
+            after = rows[-1][0]
+
+    def get_stats(self, days=30, limit=10):
+        since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT day, images, active_users FROM daily_stats WHERE day >= %s ORDER BY day",
+                      (since,))
+            daily = [{"day": day, "images": images, "active_users": users}
+                     for day, images, users in c.fetchall()]
+
+            c.execute("SELECT prompt, uses FROM prompt_stats ORDER BY uses DESC LIMIT %s", (limit,))
+            top_prompts = [{"prompt": prompt, "uses": uses} for prompt, uses in c.fetchall()]
+
+            c.execute("""
+                SELECT phone, SUM(images) AS total FROM daily_user_stats
+                WHERE day >= %s GROUP BY phone ORDER BY total DESC LIMIT %s
+            """, (since, limit))
+            top_users = [{"phone": phone, "images": int(images)} for phone, images in c.fetchall()]
+
+        return {
+            "days": days,
+            "total_images": sum(d["images"] for d in daily),
+            "daily": daily,
+            "top_prompts": top_prompts,
+            "top_users": top_users
+        }
+
+    def import_users(self, rows):
+        from psycopg2.extras import execute_values
+        with self._connection() as conn:
+            execute_values(conn.cursor(), """
+                INSERT INTO users (phone, tokens, total_generated, created_at) VALUES %s
+                ON CONFLICT (phone) DO NOTHING
+            """, rows)
+            conn.commit()
+
+    def import_generations(self, rows):
+        from psycopg2.extras import execute_values
+        with self._connection() as conn:
+            execute_values(conn.cursor(), """
+                INSERT INTO generations (phone, prompt, enhanced_prompt, image_url, created_at) VALUES %s
+            """, rows)
+            conn.commit()
+
+    def count_generations(self):
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT COUNT(*) FROM generations")
+            return c.fetchone()[0]
+
+    def rebuild_stats(self):
+        with self._connection() as conn:
+            c = conn.cursor()
+            c.execute("TRUNCATE daily_user_stats, daily_stats, prompt_stats")
+            c.execute("""
+                INSERT INTO daily_user_stats (day, phone, images)
+                SELECT to_char(created_at, 'YYYY-MM-DD'), phone, COUNT(*) FROM generations GROUP BY 1, 2
+            """)
+            c.execute("""
+                INSERT INTO daily_stats (day, images, active_users)
+                SELECT day, SUM(images), COUNT(*) FROM daily_user_stats GROUP BY day
+            """)
+            c.execute("""
+                INSERT INTO prompt_stats (prompt, uses, last_used)
+                SELECT trim(regexp_replace(lower(prompt), '\\s+', ' ', 'g')) AS p, COUNT(*), MAX(created_at)
+                FROM generations GROUP BY p
+            """)
+            conn.commit()
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def create_storage(backend=STORAGE_BACKEND):
+    if backend == "postgres":
+        return PostgresStorage(DATABASE_URL)
+    return SqliteShardedStorage(shard_paths(DB_PATH, DB_SHARDS))
+
+
+def get_storage():
+    """Stockage configuré par l'environnement (partagé par le processus)"""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = create_storage()
+        return _storage
+
+
+def migrate(source_path, target, chunk_size=MIGRATION_CHUNK):
+    """Copie users et generations d'un fichier SQLite unique vers un autre stockage"""
+    target.init()
+    if target.count_generations():
+        raise ValueError("Le stockage cible contient déjà des générations")
+
+    conn = sqlite3.connect(source_path)
+    c = conn.cursor()
+
+    after, users = "", 0
+    while True:
+        c.execute("""
+            SELECT phone, tokens, total_generated, created_at FROM users
+            WHERE phone > ? ORDER BY phone LIMIT ?
+        """, (after, chunk_size))
+        rows = c.fetchall()
+        if not rows:
+            break
+        target.import_users(rows)
+        users += len(rows)
+        after = rows[-1][0]
+        print(f"👥 {users} utilisateurs copiés")
+
+    after, generations = 0, 0
+    while True:
+        c.execute("""
+            SELECT id, phone, prompt, enhanced_prompt, image_url, created_at FROM generations
+            WHERE id > ? ORDER BY id LIMIT ?
+        """, (after, chunk_size))
+        rows = c.fetchall()
+        if not rows:
+            break
+        target.import_generations([row[1:] for row in rows])
+        generations += len(rows)
+        after = rows[-1][0]
+        print(f"🎨 {generations} générations copiées")
+
+    conn.close()
+
+    target.rebuild_stats()
+    print(f"✅ Migration terminée: {users} utilisateurs, {generations} générations")
+    return users, generations
+
+
+# Migration en ligne de commande
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migration depuis le fichier SQLite unique")
+    parser.add_argument("source", help="Fichier SQLite d'origine (ex: imagegenie.db)")
+    parser.add_argument("--backend", default=STORAGE_BACKEND, choices=["sqlite", "postgres"])
+    parser.add_argument("--shards", type=int, default=DB_SHARDS)
+    parser.add_argument("--db", default=DB_PATH, help="Chemin de base des shards")
+    args = parser.parse_args()
+
+    if args.backend == "postgres":
+        target = PostgresStorage(DATABASE_URL)
+    else:
+        paths = shard_paths(args.db, args.shards)
+        if os.path.abspath(args.source) in map(os.path.abspath, paths):
+            parser.error("la source ne peut pas être un des shards cibles")
+        target = SqliteShardedStorage(paths)
+
+    migrate(args.source, target)
@@ -0,0 +1,165 @@
+# test_broadcast.py - Teste les campagnes contre un faux serveur Graph API
+import os
+import json
+import time
+import sqlite3
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import broadcast
+import storage
+
+NB_USERS = int(os.getenv("NB_USERS", "100000"))
+
+# Messages reçus par le faux serveur (numéro -> nombre)
+received = Counter()
+received_lock = threading.Lock()
+# Numéros déjà limités une fois (429 uniquement à la première tentative)
+throttled = set()
+
+
+class GraphStub(BaseHTTPRequestHandler):
+    """
+    Faux endpoint /messages : répond 429 au premier envoi vers 1% des
+    numéros, et refuse le texte libre aux 90% qui n'ont pas écrit au bot
+    depuis 24 h (seuls les numéros finissant par 0 sont dans la fenêtre).
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        to_number = body["to"]
+
+        with received_lock:
+            first_attempt = to_number not in throttled
+            throttled.add(to_number)
+        if int(to_number) % 100 == 0 and first_attempt:
+            status, payload = 429, {"error": {"code": 130429, "message": "Rate limit hit"}}
+        elif body["type"] == "text" and int(to_number) % 10 != 0:
+            status, payload = 400, {"error": {"code": 131047, "message": "Re-engagement message"}}
+        else:
+            with received_lock:
+                received[to_number] += 1
+            status, payload = 200, {"messages": [{"id": f"wamid.{to_number}"}]}
+
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def create_fake_users(db_path, count):
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE IF NOT EXISTS users (phone TEXT PRIMARY KEY, tokens INTEGER DEFAULT 1, "
+                 "total_generated INTEGER DEFAULT 0, created_at TIMESTAMP)")
+    conn.executemany("INSERT OR IGNORE INTO users (phone, created_at) VALUES (?, datetime('now'))",
+                     ((f"229{i:08d}",) for i in range(count)))
+    conn.commit()
+    conn.close()
+
+
+def run_test():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GraphStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v18.0"
+
+    db_path = os.path.join(tempfile.mkdtemp(), "broadcast_test.db")
+    print(f"👥 Création de {NB_USERS} utilisateurs fictifs...")
+    create_fake_users(db_path, NB_USERS)
+
+    store = storage.SqliteShardedStorage([db_path])
+    store.init()
+    sender = broadcast.GraphSender(pool_size=32, base_url=base_url, token="test", phone_number_id="123")
+    # Modèle : délivré même aux utilisateurs inactifs depuis plus de 24 h
+    broadcast_id = broadcast.create_broadcast("🎉 Nouveau pack disponible!", "nouveau_pack", store=store)
+
+    # 1. Interrompre la campagne en cours de route
+    thread = broadcast.start_broadcast_thread(broadcast_id, sender=sender, store=store,
+                                              concurrency=32, rate=5000, page_size=1000, daily_limit=0)
+    while thread.is_alive() and broadcast.get_broadcast_stats(broadcast_id, store)["sent"] < NB_USERS // 3:
+        time.sleep(0.2)
+
+    # Un second lancement pendant l'envoi est refusé (sinon double envoi)
+    try:
+        broadcast.start_broadcast_thread(broadcast_id, sender=sender, store=store)
+        raise AssertionError("La campagne ne doit pas tourner deux fois")
+    except broadcast.BroadcastConflict as e:
+        print(f"🔒 Second lancement refusé: {e}")
+
+    # Une autre instance voit la campagne et la met en pause (DELETE arrivé ailleurs)
+    seen = store.get_broadcast(broadcast_id)
+    assert seen["status"] == "running" and seen["sent"] > 0
+    assert store.request_broadcast_stop(broadcast_id)
+    thread.join()
+
+    stats = broadcast.get_broadcast_stats(broadcast_id, store)
+    print(f"⏸️ Interrompue: {stats}")
+    assert stats["status"] == "paused"
+
+    # 2. Reprendre là où elle s'est arrêtée
+    start = time.monotonic()
+    result = broadcast.run_broadcast(broadcast_id, sender=sender, store=store,
+                                     concurrency=32, rate=5000, page_size=1000, daily_limit=0)
+    elapsed = time.monotonic() - start
+    print(f"▶️ Reprise: {result.to_dict()} en {elapsed:.1f}s")
+
+    # 3. Vérifications
+    conn = sqlite3.connect(db_path)
+    recorded = conn.execute("SELECT COUNT(*) FROM broadcast_results WHERE broadcast_id = ?",
+                            (broadcast_id,)).fetchone()[0]
+    conn.close()
+
+    duplicates = sum(1 for n in received.values() if n > 1)
+    print(f"📬 Reçus: {len(received)} numéros, {duplicates} doublons, {recorded} résultats enregistrés")
+
+    assert recorded == NB_USERS, "Chaque destinataire doit avoir un résultat"
+    assert len(received) == NB_USERS, "Chaque destinataire doit avoir reçu le message"
+    # L'arrêt propre enregistre les pages en vol : aucun renvoi à la reprise
+    assert duplicates == 0, "Aucun message ne doit être envoyé deux fois"
+
+    # 4. Réservation partagée : refusée si une autre instance a un checkpoint récent
+    other_id = broadcast.create_broadcast("Autre campagne", store=store)
+    assert store.claim_broadcast(other_id, datetime.now())
+    for blocked_id, error in [(other_id, broadcast.BroadcastConflict), (broadcast_id, broadcast.BroadcastConflict),
+                              (other_id + 1000, ValueError)]:
+        try:
+            broadcast.claim_broadcast(blocked_id, store)
+            raise AssertionError(f"Campagne {blocked_id} ne doit pas être réservée")
+        except error as e:
+            print(f"🔒 {e}")
+    # Checkpoint trop ancien : processus mort, la reprise est permise
+    campaign, stats = broadcast.claim_broadcast(other_id, store, stale_after=-60)
+    assert campaign["message"] == "Autre campagne" and other_id in broadcast._running
+    broadcast._running.pop(other_id)
+
+    # 5. Texte libre et palier quotidien : les NB_USERS numéros déjà joints comptent dans la limite
+    text_id = broadcast.create_broadcast("Message libre", store=store)
+    result = broadcast.run_broadcast(text_id, sender=sender, store=store, concurrency=32, rate=5000,
+                                     page_size=1000, daily_limit=NB_USERS + 1500)
+    print(f"📏 Palier quotidien: {result.to_dict()}")
+    assert result.status == "paused" and result.sent + result.failed == 1500
+    # Hors fenêtre de 24 h, le texte libre est refusé sans retry
+    assert result.sent == 150 and result.failed == 1350
+    conn = sqlite3.connect(db_path)
+    errors = conn.execute("SELECT status_code, error FROM broadcast_results WHERE broadcast_id = ? AND success = 0",
+                          (text_id,)).fetchall()
+    conn.close()
+    assert all(code == 400 and "131047" in error for code, error in errors)
+
+    server.shutdown()
+    print("✅ Test campagne réussi!")
+
+
+if __name__ == "__main__":
+    print("="*50)
+    print("TEST CAMPAGNE (BROADCAST)")
+    print("="*50)
+    run_test()
@@ -0,0 +1,291 @@
+# test_lifecycle.py - Tue des workers en pleine génération et vérifie tokens et envois
+import os
+import sys
+import json
+import time
+import queue
+import random
+import signal
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Configuration lue à l'import de storage et app : base de test partagée par les workers
+TEST_DIR = tempfile.mkdtemp()
+os.environ.update({
+    "STORAGE_BACKEND": "sqlite",
+    "DB_PATH": os.path.join(TEST_DIR, "lifecycle.db"),
+    "DB_SHARDS": "4",
+    "GOOGLE_API_KEY": "test",
+    "WHATSAPP_TOKEN": "test",
+    "PHONE_NUMBER_ID": "123",
+    "APP_SECRET": "",
+    "PROMPT_REUSE": "True",
+    # Pas de reprise automatique pendant la charge : elle est lancée à la fin
+    "JOB_RECOVERY_GRACE": "3600",
+})
+
+import lifecycle
+import storage
+import model_client
+
+NB_JOBS = int(os.getenv("NB_JOBS", "400"))
+NB_WORKERS = 4
+# Prompts répétés : une partie des jobs passe par l'index de prompts
+NB_PROMPTS = 50
+
+# Envois reçus par le faux serveur WhatsApp (numéro -> nombre)
+images = Counter()
+messages = Counter()
+errors = []
+sends_lock = threading.Lock()
+
+
+class WhatsAppStub(BaseHTTPRequestHandler):
+    """Faux endpoint /messages de la Graph API, avec latence"""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(random.uniform(0, 0.02))
+        with sends_lock:
+            if body["type"] == "image":
+                images[body["to"]] += 1
+            else:
+                messages[body["to"]] += 1
+                if body["text"]["body"].startswith("Erreur"):
+                    errors.append((body["to"], body["text"]["body"]))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class SlowGemini:
+    """Faux GenerativeModel : latence d'amélioration du prompt"""
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    def generate_content(self, request, request_options=None):
+        self.calls += 1
+        time.sleep(self.rng.uniform(0, 0.05))
+        return FakeResponse(f"enhanced {request.strip().splitlines()[-1]}")
+
+
+def load_app(stub_url, seed):
+    """Importe le vrai bot (gunicorn le fait dans chaque worker) avec Gemini et WhatsApp simulés"""
+    import app
+    app.GRAPH_API_URL = stub_url
+    app.gemini = model_client.ModelClient(SlowGemini(seed), timeout=2)
+    return app
+
+
+def webhook_body(phone, prompt):
+    return json.dumps({"entry": [{"changes": [{"field": "messages", "value": {"messages": [
+        {"from": phone, "id": f"wamid.{phone}", "type": "text", "text": {"body": f"/image {prompt}"}}]}}]}]})
+
+
+def worker_main(requests_queue, acked, stub_url, seed):
+    """Un worker gunicorn : webhooks /image reçus par la vraie route Flask"""
+    sys.stdout = open(os.devnull, "w")
+    app = load_app(stub_url, seed)
+    app.worker_lifecycle.drain_timeout = 5
+    client = app.app.test_client()
+
+    while app.worker_lifecycle.accepting:
+        try:
+            phone, prompt = requests_queue.get(timeout=0.05)
+        except queue.Empty:
+            continue
+        response = client.post("/webhook", data=webhook_body(phone, prompt), content_type="application/json")
+        if response.status_code == 200:
+            # Sans réponse 200 (worker tué avant), Meta renvoie le webhook
+            acked[phone] = True
+        elif response.status_code == 503:
+            # Meta renverra le webhook à un autre worker
+            requests_queue.put((phone, prompt))
+
+
+def start_worker(workers, requests_queue, acked, stub_url, seed):
+    workers.append(multiprocessing.Process(target=worker_main, args=(requests_queue, acked, stub_url, seed)))
+    workers[-1].start()
+
+
+def stop_workers(workers):
+    for worker in workers:
+        if worker.is_alive():
+            os.kill(worker.pid, signal.SIGTERM)
+    for worker in workers:
+        worker.join(10)
+
+
+def open_jobs(store):
+    jobs = []
+    for pool in store.pools:
+        with pool.connection() as conn:
+            jobs += conn.execute("SELECT phone, step FROM jobs").fetchall()
+    return jobs
+
+
+def generations_by_phone(store):
+    counts = Counter()
+    for pool in store.pools:
+        with pool.connection() as conn:
+            counts.update(dict(conn.execute("SELECT phone, COUNT(*) FROM generations GROUP BY phone")))
+    return counts
+
+
+def run_test(stub_url):
+    # Instance propre au test : le singleton de storage n'est créé qu'après les fork
+    store = storage.SqliteShardedStorage(storage.shard_paths(storage.DB_PATH, storage.DB_SHARDS))
+    store.init()
+    phones = [f"229{i:08d}" for i in range(NB_JOBS)]
+    store.import_users([(phone, 1, 0, "2024-01-01 00:00:00") for phone in phones])
+
+    # File et accusés de réception côté Meta : un worker tué ne les corrompt pas
+    manager = multiprocessing.Manager()
+    requests_queue = manager.Queue()
+    acked = manager.dict()
+    prompts = {phone: f"un logo pour restaurant {i % NB_PROMPTS}" for i, phone in enumerate(phones)}
+    for phone, prompt in prompts.items():
+        requests_queue.put((phone, prompt))
+
+    rng = random.Random(3)
+    seed = 0
+    workers = []
+    for _ in range(NB_WORKERS):
+        seed += 1
+        start_worker(workers, requests_queue, acked, stub_url, seed)
+
+    # Redémarrages brutaux (SIGKILL) et propres (SIGTERM) pendant la charge
+    kills = Counter()
+    deadline = time.monotonic() + 90
+    while time.monotonic() < deadline:
+        time.sleep(rng.uniform(0.2, 0.5))
+        with sends_lock:
+            done = sum(images.values())
+        if done >= NB_JOBS * 0.9 or requests_queue.empty():
+            break
+        victim = rng.choice([w for w in workers if w.is_alive()])
+        sig = rng.choice([signal.SIGKILL, signal.SIGTERM])
+        os.kill(victim.pid, sig)
+        kills[signal.Signals(sig).name] += 1
+        seed += 1
+        start_worker(workers, requests_queue, acked, stub_url, seed)
+
+    # Laisser finir la file puis arrêter proprement
+    time.sleep(3)
+    stop_workers(workers)
+    print(f"💥 Workers tués: {dict(kills)}")
+
+    # Meta renvoie chaque webhook resté sans réponse 200, y compris ceux des workers tués en plein traitement
+    for _ in range(3):
+        unacked = [phone for phone in phones if phone not in set(acked.keys())]
+        if not unacked:
+            break
+        print(f"📨 Renvoi de {len(unacked)} webhook(s) sans réponse")
+        for phone in unacked:
+            requests_queue.put((phone, prompts[phone]))
+        workers = []
+        for _ in range(NB_WORKERS):
+            seed += 1
+            start_worker(workers, requests_queue, acked, stub_url, seed)
+        deadline = time.monotonic() + 60
+        while len(acked) < len(phones) and time.monotonic() < deadline:
+            time.sleep(0.2)
+        stop_workers(workers)
+    assert len(acked) == len(phones), "Chaque webhook finit par recevoir une réponse 200"
+    print(f"📋 Jobs avant reprise: {dict(Counter(step for _, step in open_jobs(store)))}")
+
+    # Prochain démarrage : reprise des jobs interrompus par le vrai bot
+    app = load_app(stub_url, seed + 1)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        recovered = lifecycle.recover_jobs(storage.get_storage(), app.run_image_job, older_than=0)
+    finally:
+        sys.stdout = stdout
+    print(f"🔁 Jobs repris: {recovered}")
+
+    # Vérifications
+    jobs = open_jobs(store)
+    steps = Counter(step for _, step in jobs)
+    print(f"📋 Jobs: {dict(steps)}")
+
+    assert not set(steps) & set(storage.OPEN_JOB_STEPS), "Tous les jobs doivent être terminés"
+
+    assert not errors, f"Erreurs envoyées aux utilisateurs: {errors[:5]}"
+
+    # Un message (wamid) = un job, un débit, une image. Un job tué à l'étape 'sending' a peut-être
+    # été livré : il est remboursé plutôt que renvoyé, donc au plus une image.
+    steps_by_phone = dict(jobs)
+    assert len(jobs) == len(steps_by_phone) and set(steps_by_phone) == set(phones), "Un job par message"
+    debits = generations_by_phone(store)
+    wrong = []
+    for phone, step in jobs:
+        tokens, _ = store.get_or_create_user(phone)
+        refunded = step == "refunded"
+        if debits[phone] != 1 or tokens != int(refunded) or images[phone] not in ((0, 1) if refunded else (1,)):
+            wrong.append((phone, step, debits[phone], images[phone], tokens))
+    assert not wrong, f"(numéro, étape, débits, images, tokens) incorrects: {wrong[:5]}"
+
+    print(f"✅ {len(jobs)} messages, {sum(images.values())} images, un débit et au plus une image par message")
+    return app
+
+
+def test_resume_paths(app):
+    """Reprises déterministes : job déjà amélioré, job déjà débité par un autre worker"""
+    db = storage.get_storage()
+    gemini = app.gemini.model
+
+    # Job tué après l'étape 'enhanced' : ni Gemini ni l'index, l'image enregistrée est envoyée
+    phone = "22999000001"
+    db.get_or_create_user(phone)
+    job_id = db.create_job(phone, "un chat sur la lune")
+    db.update_job(phone, job_id, "enhanced", ("received",), "chat lunaire aquarelle",
+                  "https://picsum.photos/seed/reprise/512/512")
+    calls = gemini.calls
+    lifecycle.recover_jobs(db, app.run_image_job, older_than=0)
+    assert gemini.calls == calls, "Une reprise ne rappelle pas Gemini"
+    assert images[phone] == 1
+    assert db.get_or_create_user(phone)[0] == 0
+    print("✅ Job repris à 'enhanced' : image enregistrée envoyée, un seul débit")
+
+    # Deux workers reprennent le même job : le second ne prévient pas l'utilisateur.
+    # Avec 2 tokens, il bute sur JobAlreadyGenerated ; avec 1, sur le crédit épuisé.
+    for phone, tokens in [("22999000002", 2), ("22999000003", 1)]:
+        db.import_users([(phone, tokens, 0, "2024-01-01 00:00:00")])
+        job_id = db.create_job(phone, "un chien sur une voiture")
+        stale = {"id": job_id, "phone": phone, "prompt": "un chien sur une voiture", "step": "received",
+                 "enhanced_prompt": None, "image_url": None, "tokens_left": None}
+        app.run_image_job(dict(stale))
+        with sends_lock:
+            sent_messages = messages[phone]
+        app.run_image_job(dict(stale))
+        assert images[phone] == 1
+        assert messages[phone] == sent_messages, "Aucun message pour un job déjà généré"
+        assert db.get_or_create_user(phone)[0] == tokens - 1
+    assert not errors
+    print("✅ Job déjà généré ailleurs : rien d'envoyé, un seul débit")
+
+
+if __name__ == "__main__":
+    print("="*50)
+    print("TEST REDÉMARRAGE DES WORKERS")
+    print("="*50)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), WhatsAppStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub_url = f"http://127.0.0.1:{server.server_port}/v18.0"
+
+    app = run_test(stub_url)
+    test_resume_paths(app)
+    server.shutdown()
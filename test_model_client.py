@@ -0,0 +1,229 @@
+# test_model_client.py - Teste le client Gemini contre un faux modèle lent
+import io
+import time
+import random
+import threading
+from contextlib import redirect_stdout
+
+from model_client import ModelClient, CircuitBreaker
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class SlowModel:
+    """
+    Faux GenerativeModel : latence injectée, erreurs à la demande.
+
+    Comme le SDK, l'appel échoue à l'échéance de request_options, sauf
+    honors_timeout=False (transport bloqué qui ignore l'échéance).
+    """
+
+    def __init__(self, latency=0.01, slow_latency=None, slow_ratio=0.0, fail=False, seed=1, honors_timeout=True):
+        self.latency = latency
+        self.honors_timeout = honors_timeout
+        self.slow_latency = slow_latency
+        self.slow_ratio = slow_ratio
+        self.fail = fail
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def generate_content(self, request, request_options=None):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            slow = self.slow_latency and self.rng.random() < self.slow_ratio
+        delay = self.slow_latency if slow else self.latency
+        timeout = (request_options or {}).get("timeout")
+        try:
+            if self.honors_timeout and timeout is not None and delay > timeout:
+                time.sleep(timeout)
+                raise TimeoutError("504 Deadline Exceeded")
+            time.sleep(delay)
+            if self.fail:
+                raise RuntimeError("503 Service Unavailable")
+            return FakeResponse(f"  enhanced: {request}  ")
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def test_deadline():
+    print("\n⏱️ Échéance")
+    client = ModelClient(SlowModel(latency=2.0), timeout=0.2)
+    start = time.monotonic()
+    assert client.generate("chat", fallback="chat") == "chat"
+    assert time.monotonic() - start < 0.5
+    assert client.status()["timeouts"] == 1
+    print("✅ Repli sur le prompt original après 0.2s")
+
+
+def test_breaker():
+    print("\n🔌 Disjoncteur")
+    model = SlowModel(fail=True)
+    client = ModelClient(model, timeout=1, breaker=CircuitBreaker(failure_threshold=3, reset_timeout=0.3))
+
+    for _ in range(10):
+        assert client.generate("chat", fallback="chat") == "chat"
+    assert model.calls == 3, "Plus d'appels une fois le disjoncteur ouvert"
+    assert client.status()["breaker"] == "open"
+
+    # Après reset_timeout, une requête test referme le disjoncteur
+    model.fail = False
+    time.sleep(0.35)
+    assert client.generate("chat", fallback="chat") == "enhanced: chat"
+    assert client.status()["breaker"] == "closed"
+    print("✅ Ouvert après 3 échecs, refermé par la requête test")
+
+
+def test_bounded_concurrency():
+    print("\n🚦 Concurrence bornée")
+    model = SlowModel(latency=0.5)
+    client = ModelClient(model, timeout=0.1, max_concurrency=2)
+
+    threads = [threading.Thread(target=client.generate, args=("chat", "chat")) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    time.sleep(0.6)
+
+    assert model.max_in_flight <= 2
+    print(f"✅ Au plus {model.max_in_flight} appels simultanés vers l'API")
+
+
+def test_hung_upstream_opens_breaker():
+    print("\n🧊 API bloquée (places occupées par des appels abandonnés)")
+    # Valeurs par défaut : 4 places, seuil 5 ; les 4 premiers appels ne répondent jamais
+    model = SlowModel(latency=3.0, honors_timeout=False)
+    client = ModelClient(model, timeout=0.2, max_concurrency=4, slot_wait=0.05,
+                         breaker=CircuitBreaker(failure_threshold=5, reset_timeout=30))
+
+    start = time.monotonic()
+    for _ in range(12):
+        assert client.generate("chat", fallback="chat") == "chat"
+    elapsed = time.monotonic() - start
+
+    status = client.status()
+    print(f"  {status['timeouts']} délais, {status['saturated']} saturés, disjoncteur {status['breaker']}, "
+          f"{elapsed:.2f}s")
+    assert status["breaker"] == "open", "La saturation par des appels bloqués doit ouvrir le disjoncteur"
+    assert model.calls == 4
+    # Sans attendre l'échéance complète à chaque appel saturé
+    assert elapsed < 4 * 0.2 + 0.5
+    print("✅ Disjoncteur ouvert, les appels suivants repliés immédiatement")
+
+
+def test_hung_upstream_recovers():
+    print("\n🩹 API bloquée puis rétablie (échéance transmise au SDK)")
+    model = SlowModel(latency=3.0)
+    client = ModelClient(model, timeout=0.2, max_concurrency=4, slot_wait=0.05,
+                         breaker=CircuitBreaker(failure_threshold=3, reset_timeout=0.3))
+
+    output = io.StringIO()
+    with redirect_stdout(output):
+        for _ in range(5):
+            assert client.generate("chat", fallback="chat") == "chat"
+        assert client.status()["breaker"] == "open"
+        # Les appels dépassés rendent leur place peu après l'échéance
+        time.sleep(0.6)
+        assert client.status()["abandoned_in_flight"] == 0
+
+        # Deux requêtes test ratées, puis l'API répond de nouveau
+        for _ in range(2):
+            time.sleep(0.35)
+            assert client.generate("chat", fallback="chat") == "chat"
+            assert client.status()["breaker"] == "open"
+        model.latency = 0.01
+        time.sleep(0.35)
+        assert client.generate("chat", fallback="chat") == "enhanced: chat"
+
+    assert client.status()["breaker"] == "closed"
+    assert output.getvalue().count("Disjoncteur Gemini ouvert") == 1, "Un seul message à l'ouverture"
+    print("✅ Places rendues à l'échéance, disjoncteur refermé, ouverture signalée une fois")
+
+
+def test_probe_without_slot_keeps_half_open():
+    print("\n🔁 Requête test sans place libre")
+    model = SlowModel(latency=1.0, honors_timeout=False)
+    client = ModelClient(model, timeout=0.1, max_concurrency=2, slot_wait=0.05,
+                         breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.2))
+
+    for _ in range(2):
+        client.generate("chat", fallback="chat")
+    assert client.status()["breaker"] == "open"
+    failures = client.status()["consecutive_failures"]
+
+    # Places encore tenues par les appels bloqués : la requête test ne part pas
+    time.sleep(0.25)
+    for _ in range(3):
+        assert client.generate("chat", fallback="chat") == "chat"
+        status = client.status()
+        assert status["breaker"] == "half_open", "Une requête test sans place ne rouvre pas le disjoncteur"
+        assert status["consecutive_failures"] == failures
+
+    # Dès qu'une place se libère, la requête suivante referme le disjoncteur
+    model.latency = 0.01
+    while client.status()["abandoned_in_flight"]:
+        time.sleep(0.05)
+    assert client.generate("chat", fallback="chat") == "enhanced: chat"
+    assert client.status()["breaker"] == "closed"
+    print("✅ Disjoncteur à mi-ouverture jusqu'à la première place libre, puis refermé")
+
+
+def test_burst_does_not_open_breaker():
+    print("\n🌊 Pic de trafic sur une API saine")
+    model = SlowModel(latency=0.1)
+    client = ModelClient(model, timeout=1, max_concurrency=2, slot_wait=0.01,
+                         breaker=CircuitBreaker(failure_threshold=2, reset_timeout=30))
+
+    threads = [threading.Thread(target=client.generate, args=("chat", "chat")) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    status = client.status()
+    assert status["saturated"] > 0
+    assert status["breaker"] == "closed", "Un pic de trafic n'est pas une panne"
+    print(f"✅ {status['saturated']} appels saturés, disjoncteur fermé")
+
+
+def test_hedging():
+    print("\n🪂 Requêtes doublées")
+    # 4% des appels prennent 1s au lieu de 20ms : le p95 reste rapide
+    results = {}
+    for hedge in (False, True):
+        model = SlowModel(latency=0.02, slow_latency=1.0, slow_ratio=0.04, seed=7)
+        client = ModelClient(model, timeout=3, max_concurrency=8, hedge=hedge)
+        latencies = []
+        for i in range(200):
+            start = time.monotonic()
+            client.generate(f"prompt {i}", fallback="")
+            latencies.append(time.monotonic() - start)
+        latencies.sort()
+        results[hedge] = latencies[197]
+        print(f"  hedge={hedge}: p99 {latencies[197] * 1000:.0f} ms, {client.status()['hedges']} doublées")
+
+    assert results[True] < results[False] / 2
+    print("✅ Le doublement réduit la latence de queue")
+
+
+if __name__ == "__main__":
+    print("="*50)
+    print("TEST CLIENT GEMINI")
+    print("="*50)
+    test_deadline()
+    test_breaker()
+    test_bounded_concurrency()
+    test_hung_upstream_opens_breaker()
+    test_hung_upstream_recovers()
+    test_probe_without_slot_keeps_half_open()
+    test_burst_does_not_open_breaker()
+    test_hedging()
@@ -0,0 +1,112 @@
+# test_prompt_index.py - Vérifie que l'index ne réutilise que des prompts de même sens
+import prompt_index
+from prompt_index import PromptIndex
+
+STORED = [
+    "une maison avec piscine",
+    "un chien sur une voiture",
+    "un chat sous la table",
+    "portrait d'une femme africaine avec des lunettes",
+    "un éléphant rose sur une girafe bleue dans la savane",
+    "affiche pour un concert de musique africaine à cotonou avec des danseurs",
+    "un logo pour restaurant africain",
+]
+
+
+def build():
+    index = PromptIndex()
+    index.add_many((prompt, f"enhanced {prompt}", f"https://picsum.photos/seed/{i}/512/512")
+                   for i, prompt in enumerate(STORED))
+    return index
+
+
+def test_different_meaning():
+    print("\n🚫 Prompts de sens différent")
+    index = build()
+    for prompt in [
+        "une maison sans piscine",
+        "une voiture sur un chien",
+        "un chat sur la table",
+        "portrait d'une femme africaine sans lunettes",
+        "une girafe bleue sur un éléphant rose dans la savane",
+        "affiche pour un concert de musique africaine à cotonou sans danseurs",
+        "un logo restaurant africain",
+        "un logo pour restaurant asiatique",
+        "un logo moderne pour restaurant",
+    ]:
+        match = index.lookup(prompt)
+        assert match is None, f"{prompt!r} ne doit pas réutiliser {match}"
+        print(f"  ✅ {prompt}")
+
+
+def test_near_duplicates():
+    print("\n♻️ Variantes du même prompt")
+    index = build()
+    for prompt, original in [
+        ("UNE MAISON AVEC PISCINE !", "une maison avec piscine"),
+        ("le chien sur la voiture", "un chien sur une voiture"),
+        ("Portrait d'une femme africaine avec lunettes", "portrait d'une femme africaine avec des lunettes"),
+        ("affiche pour un concert de musique africaine à cotonou avec des danseurs joyeux",
+         "affiche pour un concert de musique africaine à cotonou avec des danseurs"),
+        ("affiche pour un concert de musique africain a Cotonou avec des danseurs",
+         "affiche pour un concert de musique africaine à cotonou avec des danseurs"),
+    ]:
+        match = index.lookup(prompt)
+        assert match is not None and match[0] == f"enhanced {original}", f"{prompt!r} -> {match}"
+        print(f"  ✅ {prompt} ({match[2]:.2f})")
+
+
+def test_word_order_kept():
+    print("\n🔤 Normalisation")
+    assert prompt_index.normalize("Un chien SUR une voiture") == "chien sur voiture"
+    assert prompt_index.normalize("une voiture sur un chien") == "voiture sur chien"
+    assert prompt_index.normalize("une maison sans piscine") != prompt_index.normalize("une maison avec piscine")
+    print("✅ Ordre des mots, négations et prépositions conservés")
+
+    assert prompt_index.same_meaning("chat noir", "chat noire")
+    assert prompt_index.same_meaning("logo pour restaurant", "logo pour restaurant africain")
+    assert not prompt_index.same_meaning("3 chats", "4 chats")
+    assert not prompt_index.same_meaning("logo moderne pour restaurant", "logo pour restaurant africain")
+    print("✅ Fautes de frappe et mots ajoutés acceptés, remplacements refusés")
+
+
+def test_hash_collision():
+    print("\n🧮 Collision de hash()")
+    index = build()
+    # Simule deux prompts normalisés différents de même hash()
+    colliding = prompt_index.normalize("une maison sans piscine")
+    index.keys[hash(colliding)] = index.keys[hash(prompt_index.normalize(STORED[0]))]
+    assert index.lookup("une maison sans piscine") is None, "Score 1.0 seulement pour le même texte"
+
+    # Le prompt en collision est quand même indexé et retrouvé
+    index.add("une maison sans piscine", "enhanced sans piscine", "https://picsum.photos/seed/x/512/512")
+    assert index.lookup("une maison sans piscine")[0] == "enhanced sans piscine"
+    assert index.lookup("une maison avec piscine")[0] == f"enhanced {STORED[0]}"
+    print("✅ Correspondance exacte vérifiée sur le texte, pas seulement sur le hash")
+
+
+def test_max_entries():
+    print("\n📦 Taille bornée")
+    index = PromptIndex(max_entries=4)
+    index.add_many((prompt, f"enhanced {prompt}", "url") for prompt in STORED)
+    assert len(index) == 4
+    # Les plus anciens ont laissé leur place, y compris dans les buckets
+    for prompt in STORED[:3]:
+        assert index.lookup(prompt) is None, f"{prompt!r} doit avoir été remplacé"
+    for prompt in STORED[3:]:
+        assert index.lookup(prompt)[0] == f"enhanced {prompt}"
+    positions = {pos for bucket in index.buckets for found in bucket.values()
+                 for pos in (found if isinstance(found, list) else [found])}
+    assert positions == set(range(4)) and len(index.keys) == 4
+    print("✅ Au plus max_entries prompts, les plus récents")
+
+
+if __name__ == "__main__":
+    print("="*50)
+    print(f"TEST INDEX DE PROMPTS (numpy: {prompt_index.np is not None})")
+    print("="*50)
+    test_word_order_kept()
+    test_different_meaning()
+    test_near_duplicates()
+    test_hash_collision()
+    test_max_entries()
@@ -0,0 +1,45 @@
+# test_webhook_parser.py - Teste le tri des webhooks sur des payloads au format Meta
+import json
+
+import webhook_parser
+from bench_webhook import status_payload, text_payload
+
+
+def encodings(payload):
+    """Compact (Meta) et indenté : le tri ne doit pas dépendre des espaces"""
+    return [json.dumps(payload, separators=(",", ":")).encode(),
+            json.dumps(payload).encode(),
+            json.dumps(payload, indent=2).encode().replace(b'":', b'" :')]
+
+
+def test_status_only():
+    print("\n📭 Webhooks de statuts")
+    for raw in encodings(status_payload(3)):
+        assert b'"field"' in raw and b'"messages"' in raw, "Meta envoie toujours field=messages"
+        assert not webhook_parser.has_messages(raw), raw[:80]
+        assert webhook_parser.extract_text_messages(raw) == []
+    print("✅ Ignorés sans décodage, même avec \"field\": \"messages\"")
+
+
+def test_text_messages():
+    print("\n💬 Webhooks de messages")
+    for raw in encodings(text_payload(2)):
+        assert webhook_parser.has_messages(raw)
+        assert webhook_parser.extract_text_messages(raw) == [
+            ("wamid.HBgLMTY1MDM4Nzk0MzkVAgASGBQzQTRBNjU5OUFFRTAzODEwMTQ0RgA0", "22997000000",
+             "/image un logo pour restaurant africain"),
+            ("wamid.HBgLMTY1MDM4Nzk0MzkVAgASGBQzQTRBNjU5OUFFRTAzODEwMTQ0RgA1", "22997000001",
+             "/image un logo pour restaurant africain"),
+        ]
+    # Le texte d'un utilisateur ne peut pas imiter la clé (guillemets échappés)
+    raw = json.dumps(status_payload(1) | {"note": '"messages": []'}).encode()
+    assert not webhook_parser.has_messages(raw)
+    print("✅ Tous les messages texte extraits")
+
+
+if __name__ == "__main__":
+    print("="*50)
+    print(f"TEST WEBHOOK PARSER (JSON: {webhook_parser.JSON_BACKEND})")
+    print("="*50)
+    test_status_only()
+    test_text_messages()
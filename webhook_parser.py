@@ -0,0 +1,60 @@
+# webhook_parser.py - Lecture rapide des webhooks WhatsApp (corps brut)
+import re
+import hmac
+import hashlib
+
+# Décodeur JSON rapide si disponible, sinon la bibliothèque standard
+try:
+    import orjson
+    loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    import json
+    loads = json.loads
+    JSON_BACKEND = "json"
+
+# Un webhook sans la clé "messages" ne contient que des statuts (sent, delivered, read).
+# On cherche la clé et non la chaîne : chaque livraison contient "field": "messages".
+MESSAGES_KEY = re.compile(rb'"messages"\s*:')
+
+
+def verify_signature(raw_body, signature_header, app_secret):
+    """Vérifie X-Hub-Signature-256 (HMAC-SHA256 du corps brut)"""
+    if not signature_header or not signature_header.startswith("sha256="):
+        return False
+
+    expected = hmac.new(app_secret.encode(), raw_body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature_header[7:])
+
+
+def has_messages(raw_body):
+    """Détecte les livraisons de statuts sans décoder le JSON"""
+    return MESSAGES_KEY.search(raw_body) is not None
+
+
+def extract_text_messages(raw_body):
+    """
+    Retourne les messages texte [(id, numéro, texte)] d'un webhook.
+
+    Ne parcourt que entry -> changes -> value -> messages ; le reste du
+    payload (contacts, metadata, statuts) est ignoré. L'id (wamid) est le
+    même quand Meta renvoie un webhook : il sert à ne traiter qu'une fois.
+    """
+    if not has_messages(raw_body):
+        return []
+
+    data = loads(raw_body)
+    messages = []
+
+    for entry in data.get('entry', ()):
+        for change in entry.get('changes', ()):
+            for message in change.get('value', {}).get('messages', ()):
+                if message.get('type') == 'text':
+                    messages.append((message.get('id'), message['from'], message['text']['body']))
+
+    return messages
+
+
+def preview(raw_body, limit=500):
+    """Extrait du corps brut pour les logs d'erreur"""
+    return raw_body[:limit].decode('utf-8', errors='replace')